@@ -0,0 +1,279 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Any, BinaryIO
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from telegram_bots import metrics
+from telegram_bots.logger import logger
+from telegram_bots.profiler import profiler
+
+# Status codes worth retrying, 429 is handled separately using the retry_after value Telegram sends
+RETRY_STATUSES = {500, 502, 503, 504}
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+
+def _shared_session() -> requests.Session:
+    """
+    Returns the session shared by every bot so connections to the Bot API are pooled and kept alive
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = int(os.getenv("BOT_API_POOL_SIZE", "10"))
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _session.headers["Content-Type"] = "application/json"
+        return _session
+
+
+class BotApiError(Exception):
+    pass
+
+
+# Size of the chunks files are downloaded in
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class BotApiClient:
+    base_url: str
+    file_base_url: str
+    timeout: float
+    retries: int
+
+    def __init__(self, api_token: str):
+        self.base_url = f"{os.getenv('BOT_API_URL')}/{api_token}"
+        self.file_base_url = f"{os.getenv('BOT_API_URL')}/file/{api_token}"
+        self.timeout = float(os.getenv("BOT_API_TIMEOUT", "10"))
+        self.retries = int(os.getenv("BOT_API_RETRIES", "3"))
+
+    def call(self, method: str, params: dict[str, Any] | None = None, timeout: float | None = None) -> Any:
+        """
+        Calls a Bot API method, retrying transient failures
+
+        :param method: Name of the Bot API method, e.g. sendMessage
+        :param params: Parameters for the method
+        :param timeout: Overrides the default timeout, e.g. for long polling
+        :return: The "result" field of the response
+        """
+        start = time.perf_counter()
+        try:
+            return self._call(method, params, timeout)
+        except BotApiError:
+            metrics.API_ERRORS.inc(method=method)
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            metrics.API_SECONDS.observe(seconds, method=method)
+            profiler.add_phase("api", seconds)
+
+    def file_url(self, file_path: str) -> str:
+        """
+        :param file_path: file_path returned by getFile
+        :return: URL the file can be downloaded from
+        """
+        return f"{self.file_base_url}/{file_path}"
+
+    def download(self, file_path: str, file: BinaryIO) -> int:
+        """
+        Download a file in chunks, so it is never held in memory in full
+
+        :param file_path: file_path returned by getFile
+        :param file: Open binary file the content is written to
+        :return: Number of bytes written
+        """
+        start = time.perf_counter()
+        written = 0
+        try:
+            with _shared_session().get(self.file_url(file_path), stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    raise BotApiError(f"Downloading file returned {response.status_code}")
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    file.write(chunk)
+                    written += len(chunk)
+        except requests.RequestException as e:
+            metrics.API_ERRORS.inc(method="download")
+            raise BotApiError(f"Downloading file failed ({type(e).__name__})") from e
+        except BotApiError:
+            metrics.API_ERRORS.inc(method="download")
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            metrics.API_SECONDS.observe(seconds, method="download")
+            profiler.add_phase("api", seconds)
+        return written
+
+    def read_file_head(self, file_path: str, size: int) -> bytes:
+        """
+        :return: Up to the first size bytes of a file, without downloading the rest
+        """
+        start = time.perf_counter()
+        url = self.file_url(file_path)
+        headers = {"Range": f"bytes=0-{size - 1}"}
+        try:
+            with _shared_session().get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                if response.status_code not in (200, 206):
+                    raise BotApiError(f"Downloading file returned {response.status_code}")
+                # A server ignoring the range sends the whole file, so stop reading once there is enough
+                head = b""
+                for chunk in response.iter_content(size):
+                    head += chunk
+                    if len(head) >= size:
+                        break
+                return head[:size]
+        except requests.RequestException as e:
+            metrics.API_ERRORS.inc(method="download")
+            raise BotApiError(f"Downloading file failed ({type(e).__name__})") from e
+        except BotApiError:
+            metrics.API_ERRORS.inc(method="download")
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            metrics.API_SECONDS.observe(seconds, method="download")
+            profiler.add_phase("api", seconds)
+
+    def _call(self, method: str, params: dict[str, Any] | None, timeout: float | None) -> Any:
+        body = json.dumps(params or {})
+        url = f"{self.base_url}/{method}"
+        timeout = self.timeout if timeout is None else timeout
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = _shared_session().post(url, data=body, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt > self.retries:
+                    # The exception text contains the URL, and with it the bot token
+                    raise BotApiError(f"{method} failed after {attempt} attempts ({type(e).__name__})") from e
+                delay = 2 ** (attempt - 1)
+                logger.warning(f"{method} failed ({type(e).__name__}), retrying in {delay}s")
+                time.sleep(delay)
+                continue
+
+            if response.status_code == 429 and attempt <= self.retries:
+                delay = _retry_after(response)
+                logger.warning(f"{method} rate limited, retrying in {delay}s")
+                time.sleep(delay)
+                continue
+            if response.status_code in RETRY_STATUSES and attempt <= self.retries:
+                delay = 2 ** (attempt - 1)
+                logger.warning(f"{method} returned {response.status_code}, retrying in {delay}s")
+                time.sleep(delay)
+                continue
+
+            try:
+                payload = response.json()
+            except ValueError:
+                raise BotApiError(f"{method} returned {response.status_code}: {response.text[:200]}")
+            if not payload.get("ok", False):
+                raise BotApiError(f"{method} returned {response.status_code}: {payload.get('description')}")
+            return payload.get("result")
+
+
+class AsyncBotApiClient:
+    """
+    asyncio counterpart of BotApiClient, used by the asyncio server mode. Needs an aiohttp session created inside the
+    running event loop.
+    """
+
+    base_url: str
+    session: aiohttp.ClientSession
+    timeout: float
+    retries: int
+
+    def __init__(self, api_token: str, session: aiohttp.ClientSession):
+        self.base_url = f"{os.getenv('BOT_API_URL')}/{api_token}"
+        self.session = session
+        self.timeout = float(os.getenv("BOT_API_TIMEOUT", "10"))
+        self.retries = int(os.getenv("BOT_API_RETRIES", "3"))
+
+    async def call(self, method: str, params: dict[str, Any] | None = None, timeout: float | None = None) -> Any:
+        """
+        Calls a Bot API method, retrying transient failures
+
+        :param method: Name of the Bot API method, e.g. sendMessage
+        :param params: Parameters for the method
+        :param timeout: Overrides the default timeout, e.g. for long polling
+        :return: The "result" field of the response
+        """
+        start = time.perf_counter()
+        try:
+            return await self._call(method, params, timeout)
+        except BotApiError:
+            metrics.API_ERRORS.inc(method=method)
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            metrics.API_SECONDS.observe(seconds, method=method)
+            profiler.add_phase("api", seconds)
+
+    async def _call(self, method: str, params: dict[str, Any] | None, timeout: float | None) -> Any:
+        body = json.dumps(params or {})
+        url = f"{self.base_url}/{method}"
+        client_timeout = aiohttp.ClientTimeout(total=self.timeout if timeout is None else timeout)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                async with self.session.post(
+                    url, data=body, headers={"Content-Type": "application/json"}, timeout=client_timeout
+                ) as response:
+                    status = response.status
+                    text = await response.text()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt > self.retries:
+                    raise BotApiError(f"{method} failed after {attempt} attempts ({type(e).__name__})") from e
+                delay = 2 ** (attempt - 1)
+                logger.warning(f"{method} failed ({type(e).__name__}), retrying in {delay}s")
+                await asyncio.sleep(delay)
+                continue
+
+            try:
+                payload = json.loads(text)
+            except ValueError:
+                payload = None
+
+            if status == 429 and attempt <= self.retries:
+                delay = _parse_retry_after(payload)
+                logger.warning(f"{method} rate limited, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                continue
+            if status in RETRY_STATUSES and attempt <= self.retries:
+                delay = 2 ** (attempt - 1)
+                logger.warning(f"{method} returned {status}, retrying in {delay}s")
+                await asyncio.sleep(delay)
+                continue
+
+            if payload is None:
+                raise BotApiError(f"{method} returned {status}: {text[:200]}")
+            if not payload.get("ok", False):
+                raise BotApiError(f"{method} returned {status}: {payload.get('description')}")
+            return payload.get("result")
+
+
+def _retry_after(response: requests.Response) -> float:
+    """
+    Reads the number of seconds Telegram asks us to wait before retrying
+    """
+    try:
+        return _parse_retry_after(response.json())
+    except ValueError:
+        return float(response.headers.get("Retry-After", 1))
+
+
+def _parse_retry_after(payload: dict[str, Any] | None) -> float:
+    try:
+        return float(payload["parameters"]["retry_after"])
+    except (KeyError, TypeError, ValueError):
+        return 1.0
@@ -0,0 +1,176 @@
+import asyncio
+import inspect
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import aiohttp
+from aiohttp import web
+
+from telegram_bots import metrics
+from telegram_bots.api_client import AsyncBotApiClient
+from telegram_bots.bot import Bot
+from telegram_bots.ingress import RETRY_AFTER, SECRET_HEADER, accepts, authenticate, log_request, submit_once
+from telegram_bots.logger import logger
+from telegram_bots.profiler import profiler
+from telegram_bots.worker_pool import PendingUpdates, get_chat_id, is_expired
+
+
+class AsyncWorkerPool:
+    """
+    asyncio counterpart of ShardedWorkerPool. Updates are sharded by (bot, chat) onto a fixed number of worker tasks
+    so updates from one chat are handled in order. Coroutine handlers are awaited directly, synchronous handlers are
+    run in a thread pool executor. Queue limits and expiry work as in ShardedWorkerPool.
+    """
+
+    shards: List[asyncio.Queue]
+    executor: ThreadPoolExecutor
+    tasks: List[asyncio.Task]
+    max_age: float | None
+    pending: PendingUpdates
+
+    def __init__(self, size: int, queue_size: int = 0, max_age: float | None = None):
+        if size < 1:
+            raise ValueError(f"Worker pool size must be at least 1, got {size}")
+        self.shards = [asyncio.Queue(queue_size) for _ in range(size)]
+        self.max_age = max_age
+        self.pending = PendingUpdates()
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="handler")
+        self.tasks = [asyncio.create_task(self._work(shard)) for shard in self.shards]
+
+    def shard_for(self, bot: Bot, chat_id: int | None) -> int:
+        return hash((id(bot), chat_id)) % len(self.shards)
+
+    def submit(self, bot: Bot, data: Dict[str, Any]) -> bool:
+        if not self.pending.acquire(bot):
+            metrics.UPDATES_DROPPED.inc(bot=type(bot).__name__, reason="bot_limit")
+            return False
+        try:
+            self.shards[self.shard_for(bot, get_chat_id(data))].put_nowait((bot, data, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.pending.release(bot)
+            metrics.UPDATES_DROPPED.inc(bot=type(bot).__name__, reason="queue_full")
+            return False
+        return True
+
+    def queue_depths(self) -> List[int]:
+        return [shard.qsize() for shard in self.shards]
+
+    async def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+
+    async def _work(self, shard: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            bot, data, enqueued = await shard.get()
+            if is_expired(bot, data, enqueued, self.max_age):
+                self.pending.release(bot)
+                shard.task_done()
+                continue
+            bot_name = type(bot).__name__
+            start = time.perf_counter()
+            metrics.QUEUE_WAIT.observe(start - enqueued, bot=bot_name)
+            state = "none"
+            try:
+                state = bot.state_label(data)
+                if inspect.iscoroutinefunction(bot.handle_message):
+                    # Not profiled, samples of the event loop thread would include every other running task
+                    await bot.handle_message(data)
+                else:
+                    handler = profiler.wrap(bot_name, bot.handle_message, f"update {data.get('update_id')}")
+                    await loop.run_in_executor(self.executor, handler, data)
+            except Exception as e:
+                metrics.HANDLER_ERRORS.inc(bot=bot_name)
+                error = f"{type(e).__name__}: {e}"
+                logger.error(error)
+                logger.error(traceback.format_exc())
+                try:
+                    chat_id = get_chat_id(data)
+                    if chat_id is not None:
+                        await bot.send_message_async(error, chat_id)
+                except Exception as e:
+                    logger.error(f"Failed to send error message: {type(e).__name__}: {e}")
+                    logger.error(traceback.format_exc())
+            finally:
+                metrics.HANDLER_SECONDS.observe(time.perf_counter() - start, bot=bot_name, state=state)
+                self.pending.release(bot)
+                shard.task_done()
+
+
+def create_app(
+    bots: Dict[str, Bot], pool_size: int, queue_size: int = 0, max_age: float | None = None
+) -> web.Application:
+    """
+    Builds the aiohttp application serving the same routes as the Flask app
+
+    :param bots: Dict of subdomain to Bot instance
+    :param pool_size: Number of worker tasks handling updates
+    :param queue_size: Most updates waiting on each worker task, 0 for no limit
+    :param max_age: Seconds after which a queued update is dropped, None to handle every update
+    :return: aiohttp application
+    """
+    app = web.Application()
+
+    async def on_startup(app: web.Application) -> None:
+        app["session"] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        for bot in bots.values():
+            bot.async_api = AsyncBotApiClient(bot.api_token, app["session"])
+        app["pool"] = AsyncWorkerPool(pool_size, queue_size, max_age)
+
+    async def on_cleanup(app: web.Application) -> None:
+        await app["pool"].close()
+        await app["session"].close()
+
+    async def health_check(request: web.Request) -> web.Response:
+        log_request("Health check", request.headers)
+        host = request.host.split(".")[0]
+        if host in bots:
+            return web.json_response({"status": "ok", "queue_depths": app["pool"].queue_depths()}, status=200)
+        else:
+            return web.json_response({"status": "not found"}, status=404)
+
+    async def metrics_route(request: web.Request) -> web.Response:
+        for shard, depth in enumerate(app["pool"].queue_depths()):
+            metrics.QUEUE_DEPTH.set(depth, shard=shard)
+        return web.Response(body=metrics.render().encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+    async def webhook(request: web.Request) -> web.Response:
+        host = request.host.split(".")[0]
+        bot = bots.get(host)
+        if not authenticate(bot, request.headers.get(SECRET_HEADER)):
+            log_request("Webhook", request.headers)
+            logger.debug("Authentication failed")
+            return web.json_response({"status": "unauthorized"}, status=401)
+
+        try:
+            update = await request.json()
+        except ValueError:
+            update = None
+        log_request("Webhook", request.headers, update)
+        if not isinstance(update, dict):
+            return web.json_response({"status": "bad request"}, status=400)
+
+        logger.info("Webhook received for: %s", host)
+        if accepts(bot, update):
+            if not submit_once(bot, update, app["pool"].submit):
+                return web.json_response({"status": "busy"}, status=503, headers={"Retry-After": RETRY_AFTER})
+            return web.json_response({"status": "success"}, status=200)
+        else:
+            return web.Response(status=204)
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_get("/health_check", health_check)
+    app.router.add_get("/metrics", metrics_route)
+    app.router.add_post("/webhook", webhook)
+    return app
+
+
+def serve(
+    bots: Dict[str, Bot], host: str, port: int, pool_size: int, queue_size: int = 0, max_age: float | None = None
+) -> None:
+    web.run_app(create_app(bots, pool_size, queue_size, max_age), host=host, port=port, print=None)
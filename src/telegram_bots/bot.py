@@ -1,14 +1,15 @@
-import json
+import atexit
 import os
-import sqlite3
-from contextlib import contextmanager
 from sqlite3 import Cursor
-from typing import Generator
+from typing import ContextManager, Set, Tuple
 
-import requests
 from dotenv import load_dotenv
 
+from telegram_bots.api_client import AsyncBotApiClient, BotApiClient, BotApiError
+from telegram_bots.database import ConnectionManager, get_connection_manager
+from telegram_bots.dedupe import UpdateWindow
 from telegram_bots.logger import logger
+from telegram_bots.util import ConversationStore
 
 load_dotenv()
 
@@ -16,39 +17,111 @@ load_dotenv()
 class Bot:
     api_token: str
     secret_token: str
-    message_url: str
+    api: BotApiClient
+    # Only set when running in the asyncio server mode
+    async_api: AsyncBotApiClient | None
+    # IDs of recently received updates, to drop updates Telegram delivers again
+    recent_updates: UpdateWindow
+    # Update types passed to handle_message, any other update is dropped when it arrives
+    update_types: Tuple[str, ...] = ("message",)
+    # Most updates queued or in progress for this bot at once, None for no limit besides the shard queue size
+    max_queued: int | None = None
+    # Conversation state of each chat, keyed by chat ID as a string, for bots that hold conversations
+    conversations: ConversationStore | None = None
 
     def __init__(self, api_token, secret_token):
         self.api_token = api_token
         self.secret_token = secret_token
-        self.message_url = f"{os.getenv("BOT_API_URL")}/{self.api_token}/sendMessage"
+        self.api = BotApiClient(self.api_token)
+        self.async_api = None
+        persist = os.getenv("UPDATE_DEDUPE_PERSIST", "false").lower() == "true"
+        self.recent_updates = UpdateWindow(
+            int(os.getenv("UPDATE_DEDUPE_SIZE", "1000")),
+            type(self).__name__,
+            get_connection_manager(os.getenv("DATABASE_PATH")) if persist else None,
+        )
+        atexit.register(self.recent_updates.close)
 
     def handle_message(self, message):
+        """
+        Handle an incoming update. May be overridden with a coroutine function when the bot is only run in the asyncio
+        server mode, otherwise it is run in an executor.
+        """
         raise NotImplementedError()
 
+    def state_label(self, data) -> str:
+        """
+        :param data: Update payload from Telegram
+        :return: Name of the chat's conversation state before the update is handled, used to label handler metrics
+        """
+        chat_id = data.get("message", {}).get("chat", {}).get("id")
+        if self.conversations is None or chat_id is None:
+            return "none"
+        state = self.conversations.peek_state(str(chat_id))
+        return "idle" if state is None else state.name.lower()
+
     def send_message(self, text, chat_id, replay_markup=None):
         data = {"text": text, "chat_id": chat_id}
         if replay_markup is not None:
             data["reply_markup"] = replay_markup
         logger.info(f"Sending message to {chat_id}: {text}")
-        requests.post(
-            self.message_url,
-            headers={"Content-Type": "application/json"},
-            data=json.dumps(data),
-        )
+        try:
+            self.api.call("sendMessage", data)
+        except BotApiError as e:
+            logger.error(f"Failed to send message to {chat_id}: {e}")
+
+    async def send_message_async(self, text, chat_id, replay_markup=None):
+        data = {"text": text, "chat_id": chat_id}
+        if replay_markup is not None:
+            data["reply_markup"] = replay_markup
+        logger.info(f"Sending message to {chat_id}: {text}")
+        try:
+            await self.async_api.call("sendMessage", data)
+        except BotApiError as e:
+            logger.error(f"Failed to send message to {chat_id}: {e}")
+
+    def send_chat_action(self, chat_id, action="typing"):
+        try:
+            self.api.call("sendChatAction", {"action": action, "chat_id": chat_id})
+        except BotApiError as e:
+            logger.error(f"Failed to send chat action to {chat_id}: {e}")
 
 
 class DatabaseBot(Bot):
     db_path: str
+    db: ConnectionManager
+    # Table of registered chat IDs, for bots that welcome new users
+    users_table: str | None = None
+    registered_users: Set[str]
 
     def __init__(self, api_token, secret_token):
         super().__init__(api_token, secret_token)
         self.db_path = os.getenv("DATABASE_PATH")
+        self.db = get_connection_manager(self.db_path)
+        self.registered_users = set()
+
+    def db_cursor(self) -> ContextManager[Cursor]:
+        return self.db.cursor()
+
+    def load_registered_users(self):
+        """
+        Fill the registered user cache from users_table, should be called once the table exists
+        """
+        with self.db_cursor() as cursor:
+            cursor.execute(f"SELECT chat_id FROM {self.users_table}")
+            self.registered_users = {row[0] for row in cursor.fetchall()}
+
+    def register_user(self, chat_id: str) -> bool:
+        """
+        Register a chat as a user of the bot, only touching the database for chats not registered yet
 
-    @contextmanager
-    def db_cursor(self) -> Generator[Cursor]:
-        connection = sqlite3.connect(self.db_path)
-        cursor = connection.cursor()
-        yield cursor
-        connection.commit()
-        connection.close()
+        :param chat_id: ID of the chat
+        :return: True if the chat was newly registered
+        """
+        if chat_id in self.registered_users:
+            return False
+        with self.db_cursor() as cursor:
+            cursor.execute(f"INSERT OR IGNORE INTO {self.users_table} (chat_id) VALUES (?)", (chat_id,))
+            added = cursor.rowcount == 1
+        self.registered_users.add(chat_id)
+        return added
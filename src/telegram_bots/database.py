@@ -0,0 +1,139 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from sqlite3 import Connection, Cursor
+from typing import Dict, Generator, List
+
+from telegram_bots import metrics
+from telegram_bots.logger import logger
+from telegram_bots.profiler import profiler
+
+# Statement types DB time is reported under, anything else is reported as other
+QUERY_TYPES = {"SELECT", "INSERT", "UPDATE", "DELETE", "CREATE", "ALTER", "DROP", "PRAGMA", "BEGIN"}
+
+
+class TimedCursor(Cursor):
+    """
+    Cursor recording how long each statement takes to execute, by statement type
+    """
+
+    def execute(self, sql, parameters=(), /):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, parameters, /):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self._record(sql, time.perf_counter() - start)
+
+    @staticmethod
+    def _record(sql: str, seconds: float) -> None:
+        metrics.DB_SECONDS.observe(seconds, query=_query_type(sql))
+        profiler.add_phase("db", seconds)
+
+
+def _query_type(sql: str) -> str:
+    words = sql.split(None, 1)
+    query_type = words[0].upper() if words else ""
+    return query_type if query_type in QUERY_TYPES else "OTHER"
+
+
+class ConnectionManager:
+    """
+    Hands out one long-lived SQLite connection per thread for a database file.
+
+    Connections run in WAL mode so readers don't block behind a writer, and wait for a busy timeout instead of failing
+    immediately when another thread holds the write lock.
+    """
+
+    path: str
+    busy_timeout: int
+    connections: List[Connection]
+
+    def __init__(self, path: str, busy_timeout: int = 5000):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.connections = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def connection(self) -> Connection:
+        """
+        :return: The calling thread's connection, opening it on first use
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Each connection is only ever used by the thread that opened it, but close() may run on another thread
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA busy_timeout={self.busy_timeout}")
+            self._local.connection = connection
+            self._local.depth = 0
+            with self._lock:
+                self.connections.append(connection)
+        return connection
+
+    @contextmanager
+    def cursor(self) -> Generator[Cursor]:
+        """
+        Yields a cursor on the calling thread's connection. The transaction is committed when the outermost cursor
+        exits and rolled back if it raises.
+        """
+        connection = self.connection()
+        cursor = connection.cursor(TimedCursor)
+        self._local.depth += 1
+        try:
+            yield cursor
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                connection.rollback()
+            raise
+        else:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                connection.commit()
+        finally:
+            cursor.close()
+
+    def close(self) -> None:
+        """
+        Closes every connection opened by this manager
+        """
+        with self._lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            try:
+                connection.close()
+            except sqlite3.Error as e:
+                logger.error(f"Failed to close database connection: {e}")
+        # Threads that still hold a closed connection will open a new one on next use
+        self._local = threading.local()
+
+
+_managers: Dict[str, ConnectionManager] = {}
+_managers_lock = threading.Lock()
+
+
+def get_connection_manager(path: str) -> ConnectionManager:
+    """
+    Returns the connection manager for a database file, shared by every bot using that file
+
+    :param path: Path to the SQLite database
+    :return: ConnectionManager for the path
+    """
+    with _managers_lock:
+        if path not in _managers:
+            manager = ConnectionManager(path, int(os.getenv("DATABASE_BUSY_TIMEOUT", "5000")))
+            atexit.register(manager.close)
+            _managers[path] = manager
+        return _managers[path]
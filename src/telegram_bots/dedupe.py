@@ -0,0 +1,128 @@
+import queue
+import sqlite3
+import threading
+from array import array
+from typing import Any, Set, Tuple
+
+from telegram_bots.database import ConnectionManager
+from telegram_bots.logger import logger
+
+
+class UpdateWindow:
+    """
+    Remembers the most recent update IDs of a bot so redelivered updates can be recognised.
+
+    IDs are kept in a fixed size ring buffer, with a set for lookups, so the oldest ID is forgotten when a new one is
+    added to a full window. If a database is given, the window is also stored in updates_seen and reloaded on
+    startup, so updates redelivered across a restart are recognised too. Those writes are made by a background thread
+    in batches, so recording an update never waits on SQLite, which would block the event loop of the asyncio server.
+    """
+
+    size: int
+    key: str
+
+    def __init__(self, size: int, key: str, db: ConnectionManager | None = None):
+        if size < 1:
+            raise ValueError(f"Update window size must be at least 1, got {size}")
+        self.size = size
+        self.key = key
+        self.db = db
+        self._ring = array("q", [-1] * size)
+        self._next = 0
+        self._seen: Set[int] = set()
+        self._lock = threading.Lock()
+        # Statements for the writer thread, None tells it to stop
+        self._writes: queue.SimpleQueue[Tuple[str, Tuple[Any, ...]] | None] = queue.SimpleQueue()
+        self._writer: threading.Thread | None = None
+
+        if self.db is not None:
+            with self.db.cursor() as cursor:
+                cursor.execute(
+                    "CREATE TABLE IF NOT EXISTS updates_seen "
+                    "(bot TEXT, update_id INTEGER, PRIMARY KEY (bot, update_id))"
+                )
+                cursor.execute(
+                    "SELECT update_id FROM updates_seen WHERE bot = ? ORDER BY update_id DESC LIMIT ?", (key, size)
+                )
+                update_ids = [row[0] for row in cursor.fetchall()]
+                cursor.execute(
+                    "DELETE FROM updates_seen WHERE bot = ? AND update_id < ?",
+                    (key, update_ids[-1] if update_ids else 0),
+                )
+            for update_id in reversed(update_ids):
+                self._store(update_id)
+            self._writer = threading.Thread(target=self._write, name=f"dedupe-{key}", daemon=True)
+            self._writer.start()
+
+    def add(self, update_id: int) -> bool:
+        """
+        Record an update ID
+
+        :param update_id: ID of the incoming update
+        :return: False if the ID is already in the window, i.e. the update is a redelivery
+        """
+        with self._lock:
+            if update_id in self._seen:
+                return False
+            evicted = self._store(update_id)
+            if self.db is not None:
+                self._writes.put(("INSERT OR IGNORE INTO updates_seen VALUES (?, ?)", (self.key, update_id)))
+                if evicted >= 0:
+                    self._writes.put(("DELETE FROM updates_seen WHERE bot = ? AND update_id = ?", (self.key, evicted)))
+            return True
+
+    def discard(self, update_id: int) -> None:
+        """
+        Forget an update ID, e.g. when the update couldn't be queued and should be accepted when redelivered
+        """
+        with self._lock:
+            if update_id not in self._seen:
+                return
+            self._seen.discard(update_id)
+            self._ring[self._ring.index(update_id)] = -1
+            if self.db is not None:
+                self._writes.put(("DELETE FROM updates_seen WHERE bot = ? AND update_id = ?", (self.key, update_id)))
+
+    def close(self) -> None:
+        """
+        Write the remaining IDs to the database and stop the writer thread
+        """
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def __contains__(self, update_id: int) -> bool:
+        return update_id in self._seen
+
+    def _store(self, update_id: int) -> int:
+        """
+        :return: The ID evicted to make room, or -1 if the slot was empty
+        """
+        evicted = self._ring[self._next]
+        self._seen.discard(evicted)
+        self._ring[self._next] = update_id
+        self._next = (self._next + 1) % self.size
+        self._seen.add(update_id)
+        return evicted
+
+    def _write(self) -> None:
+        """
+        Runs on the writer thread, committing every statement queued since the last batch in one transaction
+        """
+        while True:
+            writes = [self._writes.get()]
+            try:
+                while True:
+                    writes.append(self._writes.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                with self.db.cursor() as cursor:
+                    for write in writes:
+                        if write is not None:
+                            cursor.execute(*write)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to store update IDs of {self.key}: {e}")
+            if None in writes:
+                return
@@ -1,13 +1,19 @@
-import atexit
-from collections import defaultdict
-from datetime import datetime
-from typing import Dict
-
-from apscheduler.schedulers.background import BackgroundScheduler
+import calendar
+import enum
+from datetime import date, datetime, timedelta
+from typing import List
 
 from telegram_bots import util
 from telegram_bots.bot import DatabaseBot
 from telegram_bots.logger import logger
+from telegram_bots.scheduler import SchedulerService
+
+
+class States(enum.Enum):
+    ADDING_ITEM = "adding_item"
+    ADDING_DATE = "adding_date"
+    REMOVING_ITEM = "removing_item"
+
 
 CUSTOM_KEYBOARD = {
     "keyboard": [[{"text": "Add"}, {"text": "List"}, {"text": "Remove"}]],
@@ -18,106 +24,132 @@ CUSTOM_KEYBOARD = {
 
 
 class ExpiryBot(DatabaseBot):
-    user_state: Dict[str, Dict[str, str]]
-    sched: BackgroundScheduler
+    users_table = "users_expiry"
+    # Conversation state, with the name of the item being added as its data
+    conversations: util.ConversationStore
+    scheduler: SchedulerService
 
-    def __init__(self, bot_token, bot_secret):
+    def __init__(self, bot_token, bot_secret, scheduler: SchedulerService):
         logger.debug("Initialising ExpiryBot...")
         super().__init__(f"bot{bot_token}", bot_secret)
-        self.user_state = defaultdict(lambda: {"state": "idle", "item": None})
-        self.sched = BackgroundScheduler(daemon=True)
+        self.conversations = util.ConversationStore(States)
+        self.scheduler = scheduler
 
         with self.db_cursor() as cursor:
-            cursor.execute("CREATE TABLE IF NOT EXISTS items_expiry (name TEXT, date TEXT)")
+            cursor.execute("CREATE TABLE IF NOT EXISTS items_expiry (name TEXT, expires INTEGER)")
             cursor.execute("CREATE TABLE IF NOT EXISTS users_expiry (chat_id TEXT UNIQUE)")
+        self._migrate_items()
+        with self.db_cursor() as cursor:
+            cursor.execute("CREATE INDEX IF NOT EXISTS items_expiry_expires ON items_expiry (expires)")
+        self.load_registered_users()
 
-        self.sched.add_job(self._send_notifications, "cron", hour=10, minute=0)
-        self.sched.start()
-        atexit.register(lambda: self.sched.shutdown())
+        self.scheduler.add_job(self._send_notifications, "cron", hour=10, minute=0)
 
         logger.info("ExpiryBot initialised")
 
+    def _migrate_items(self):
+        """
+        Converts items_expiry from ISO date strings in a date column to day ordinals in an expires column
+        """
+        with self.db_cursor() as cursor:
+            columns = [column[1] for column in cursor.execute("PRAGMA table_info(items_expiry)")]
+            if "date" not in columns:
+                return
+            logger.info("Migrating items_expiry to ordinal dates...")
+            cursor.execute("BEGIN")
+            if "expires" not in columns:
+                cursor.execute("ALTER TABLE items_expiry ADD COLUMN expires INTEGER")
+            cursor.execute("SELECT rowid, name, date FROM items_expiry")
+            updates = []
+            unreadable = []
+            for rowid, name, expiry in cursor.fetchall():
+                expires = _parse_legacy_date(expiry)
+                if expires is None:
+                    logger.error(f"Removing {name}, its expiry date {expiry!r} can't be read")
+                    unreadable.append((rowid,))
+                    continue
+                if expires.isoformat() != expiry:
+                    logger.warning(f"Moving expiry date of {name} from {expiry} to {expires}")
+                updates.append((expires.toordinal(), rowid))
+            cursor.executemany("UPDATE items_expiry SET expires = ? WHERE rowid = ?", updates)
+            cursor.executemany("DELETE FROM items_expiry WHERE rowid = ?", unreadable)
+            cursor.execute("ALTER TABLE items_expiry DROP COLUMN date")
+
     def _send_notifications(self):
+        today = datetime.now().date()
+        tomorrow = today + timedelta(days=1)
         with self.db_cursor() as cursor:
-            cursor.execute("SELECT name, date FROM items_expiry")
+            cursor.execute(
+                "SELECT name, expires FROM items_expiry WHERE expires <= ? ORDER BY expires", (tomorrow.toordinal(),)
+            )
             rows = cursor.fetchall()
-            cursor.execute("SELECT chat_id FROM users_expiry")
-            users = [x[0] for x in cursor.fetchall()]
-        today = datetime.now().date()
-        for row in rows:
-            item_name = row[0]
-            expiration_date = datetime.strptime(row[1], "%Y-%m-%d").date()
-            for chat_id in users:
-                if expiration_date == today:
-                    self.send_message(f"{item_name} will expire today", chat_id)
-                elif expiration_date == today.replace(day=today.day + 1):
-                    self.send_message(f"{item_name} will expire tomorrow", chat_id)
-                elif expiration_date < today:
-                    self.send_message(f"{item_name} has expired!", chat_id)
+
+        digest = _build_digest(rows, today)
+        if digest is None:
+            return
+        # Items are shared by every user, so they all receive the same digest
+        messages = util.split_message(digest)
+        for chat_id in list(self.registered_users):
+            for message in messages:
+                self.send_message(message, chat_id)
 
     def handle_message(self, data):
         text = data["message"]["text"]
         chat_id = str(data["message"]["chat"]["id"])
 
-        with self.db_cursor() as cursor:
-            cursor.execute("SELECT chat_id FROM users_expiry")
-            users = cursor.fetchall()
-            if (chat_id,) not in users:
-                cursor.execute("INSERT INTO users_expiry (chat_id) VALUES (?)", (chat_id,))
-                self.send_message(
-                    "Welcome to ExpiryBot! Use the keyboard below to manage your items.\n\n"
-                    "You will now receive notifications when items are about to expire. If this is a mistake, please contact the bot admin.",
-                    chat_id,
-                    CUSTOM_KEYBOARD,
-                )
-                return
-        state = self.user_state[chat_id]["state"]
+        if self.register_user(chat_id):
+            self.send_message(
+                "Welcome to ExpiryBot! Use the keyboard below to manage your items.\n\n"
+                "You will now receive notifications when items are about to expire. If this is a mistake, please contact the bot admin.",
+                chat_id,
+                CUSTOM_KEYBOARD,
+            )
+            return
+        state = self.conversations.get_state(chat_id)
 
         if text.lower() == "stop":  # Catch-all to reset state
-            self.user_state[chat_id]["state"] = "idle"
-            self.user_state[chat_id]["item"] = None
+            self.conversations.clear(chat_id)
             self.send_message("Operation cancelled.", chat_id, CUSTOM_KEYBOARD)
-        elif text == "Add" and state == "idle":  # Start adding an item
-            self.user_state[chat_id]["state"] = "adding_item"
+        elif text == "Add" and state is None:  # Start adding an item
+            self.conversations.set_state(chat_id, States.ADDING_ITEM)
             self.send_message("Please provide the item to add:", chat_id, {"remove_keyboard": True})
-        elif state == "adding_item":  # Got item name, now ask for date
-            self.user_state[chat_id]["state"] = "adding_date"
-            self.user_state[chat_id]["item"] = text
+        elif state == States.ADDING_ITEM:  # Got item name, now ask for date
+            self.conversations.set_state(chat_id, States.ADDING_DATE)
+            self.conversations.set_data(chat_id, text)
             self.send_message("Please provide the expiration date (DD/MM):", chat_id)
-        elif state == "adding_date":  # Got date, validate and store
+        elif state == States.ADDING_DATE:  # Got date, validate and store
             self._save_item(text, chat_id)
-        elif text == "List" and state == "idle":  # List items
+        elif text == "List" and state is None:  # List items
             self._send_list(chat_id)
-        elif text == "Remove" and state == "idle":  # Start removing an item by showing options
+        elif text == "Remove" and state is None:  # Start removing an item by showing options
             self._send_remove_options(chat_id)
-        elif state == "removing_item":  # Remove selected item
+        elif state == States.REMOVING_ITEM:  # Remove selected item
             item_to_remove = text
             with self.db_cursor() as cursor:
                 cursor.execute("DELETE FROM items_expiry WHERE name = ?", (item_to_remove,))
             self.send_message(f"{item_to_remove} has been removed.", chat_id, CUSTOM_KEYBOARD)
-            self.user_state[chat_id]["state"] = "idle"
+            self.conversations.clear_state(chat_id)
 
     def _send_list(self, chat_id):
         with self.db_cursor() as cursor:
-            cursor.execute("SELECT name, date FROM items_expiry")
+            cursor.execute("SELECT name, expires FROM items_expiry ORDER BY expires")
             rows = cursor.fetchall()
         if not rows:
             self.send_message("No items found.", chat_id, CUSTOM_KEYBOARD)
         else:
-            rows.sort(key=lambda x: datetime.strptime(x[1], "%Y-%m-%d"))
             message = "Items:\n"
             for row in rows:
-                message += f"- {row[0]} (expires on {row[1]})\n"
+                message += f"- {row[0]} (expires on {date.fromordinal(row[1]).isoformat()})\n"
             self.send_message(message, chat_id, CUSTOM_KEYBOARD)
 
     def _send_remove_options(self, chat_id):
-        self.user_state[chat_id]["state"] = "removing_item"
+        self.conversations.set_state(chat_id, States.REMOVING_ITEM)
         with self.db_cursor() as cursor:
-            cursor.execute("SELECT name FROM items_expiry")
+            cursor.execute("SELECT name FROM items_expiry ORDER BY expires")
             rows = cursor.fetchall()
         if not rows:
             self.send_message("No items to remove.", chat_id, CUSTOM_KEYBOARD)
-            self.user_state[chat_id]["state"] = "idle"
+            self.conversations.clear_state(chat_id)
         else:
             options = [[{"text": row[0]}] for row in rows]
             self.send_message(
@@ -126,12 +158,12 @@ class ExpiryBot(DatabaseBot):
                 {"keyboard": [*options], "resize_keyboard": True, "input_field_placeholder": "Choose an option"},
             )
 
-    def _save_item(self, date, chat_id):
-        if "/" not in date:
+    def _save_item(self, date_text, chat_id):
+        if "/" not in date_text:
             self.send_message("Invalid date format. Please provide the expiration date in DD/MM format:", chat_id)
             return
-        day = date.split("/")[0]
-        month = date.split("/")[1]
+        day = date_text.split("/")[0]
+        month = date_text.split("/")[1]
         try:
             day = int(day)
             month = int(month)
@@ -141,11 +173,59 @@ class ExpiryBot(DatabaseBot):
             self.send_message("Invalid date format. Please provide the expiration date in DD/MM format:", chat_id)
             return
         year = util.get_future_year(day, month)
-        date = f"{year}-{month:02d}-{day:02d}"
+        try:
+            expiry = date(year, month, day)
+        except ValueError:
+            self.send_message("Invalid date format. Please provide the expiration date in DD/MM format:", chat_id)
+            return
+        item = self.conversations.get_data(chat_id)
         with self.db_cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO items_expiry (name, date) VALUES (?, ?)", (self.user_state[chat_id]["item"], date)
-            )
-        self.send_message(f"{self.user_state[chat_id]['item']} will expire on {date}", chat_id, CUSTOM_KEYBOARD)
-        self.user_state[chat_id]["state"] = "idle"
-        self.user_state[chat_id]["item"] = None
+            cursor.execute("INSERT INTO items_expiry (name, expires) VALUES (?, ?)", (item, expiry.toordinal()))
+        self.send_message(f"{item} will expire on {expiry.isoformat()}", chat_id, CUSTOM_KEYBOARD)
+        self.conversations.clear(chat_id)
+
+
+def _parse_legacy_date(text: str) -> date | None:
+    """
+    Parses a date stored before expiry dates were validated, which may be impossible such as "2025-02-31"
+
+    :param text: Date in the format YYYY-MM-DD
+    :return: The date, clamped to the last day of its month, or None if it can't be read at all
+    """
+    try:
+        year, month, day = (int(part) for part in text.split("-"))
+        return date(year, month, min(max(day, 1), calendar.monthrange(year, month)[1]))
+    except (AttributeError, ValueError):
+        return None
+
+
+def _build_digest(rows: List[tuple[str, int]], today: date) -> str | None:
+    """
+    Builds a single notification listing expired items and items expiring today or tomorrow
+
+    :param rows: (name, expires) rows from items_expiry
+    :param today: Date to compare expiry dates against
+    :return: Digest message or None if nothing needs notifying
+    """
+    tomorrow = today + timedelta(days=1)
+    expired, expiring_today, expiring_tomorrow = [], [], []
+    for name, expires in rows:
+        expiration_date = date.fromordinal(expires)
+        if expiration_date < today:
+            expired.append(name)
+        elif expiration_date == today:
+            expiring_today.append(name)
+        elif expiration_date == tomorrow:
+            expiring_tomorrow.append(name)
+
+    sections = []
+    for title, names in (
+        ("Expired", expired),
+        ("Expiring today", expiring_today),
+        ("Expiring tomorrow", expiring_tomorrow),
+    ):
+        if names:
+            sections.append(f"{title}:\n" + "\n".join(f"- {name}" for name in names))
+    if not sections:
+        return None
+    return "\n\n".join(sections)
@@ -1,14 +1,17 @@
-import atexit
 import enum
+import os
+import threading
 from datetime import datetime, timedelta
 from typing import Dict, Tuple
 
+from apscheduler.events import EVENT_JOB_MISSED, JobExecutionEvent
 from apscheduler.job import Job
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.base import JobLookupError
 
 from telegram_bots import util
 from telegram_bots.bot import DatabaseBot
 from telegram_bots.logger import logger
+from telegram_bots.scheduler import SchedulerService
 
 
 class States(enum.Enum):
@@ -18,6 +21,9 @@ class States(enum.Enum):
     REMOVE_TASK = "remove_task"
 
 
+# Format of alert_time in tasks_hassle, which sorts chronologically as text
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
 CUSTOM_KEYBOARD = {
     "keyboard": [[{"text": "Add"}, {"text": "List"}, {"text": "Remove"}]],
     "resize_keyboard": True,
@@ -50,37 +56,89 @@ def _parse_date(date_text: str) -> datetime | None:
 
 
 class HassleBot(DatabaseBot):
-    state_manager: util.StateManager = util.StateManager(States)
-    sched: BackgroundScheduler
+    users_table = "users_hassle"
+    # Conversation state, with the name and alert time of the task being created as its data
+    conversations: util.ConversationStore
+    scheduler: SchedulerService
     # Contains the scheduled job for a task and a bool indicating if it is currently hassling
     jobs: Dict[str, Tuple[Job, bool]]
-    task_buffer: Dict[str, Tuple[str, datetime]]
+    # Jobs of the tasks currently hassling each chat, keyed by chat ID then task name
+    active: Dict[str, Dict[str, Job]]
+    # Only tasks due within this window are scheduled, the rest are loaded as the window moves
+    window: timedelta
 
-    def __init__(self, bot_token: str, bot_secret: str):
+    def __init__(self, bot_token: str, bot_secret: str, scheduler: SchedulerService):
         logger.debug("Initialising HassleBot...")
         super().__init__(f"bot{bot_token}", bot_secret)
 
-        self.task_buffer = {}
+        self.conversations = util.ConversationStore(States)
         self.jobs = {}
+        self.active = {}
+        self.jobs_lock = threading.RLock()
+        self.window = timedelta(minutes=int(os.getenv("HASSLE_WINDOW_MINUTES", "60")))
 
-        self.sched = BackgroundScheduler(daemon=True)
-        self.sched.start()
-        atexit.register(lambda: self.sched.shutdown())
+        self.scheduler = scheduler
 
         with self.db_cursor() as cursor:
             cursor.execute(
                 "CREATE TABLE IF NOT EXISTS tasks_hassle (name TEXT, alert_time TEXT, repeat TEXT, chat_id TEXT)"
             )
+            cursor.execute("CREATE INDEX IF NOT EXISTS tasks_hassle_alert_time ON tasks_hassle (alert_time)")
             cursor.execute("CREATE TABLE IF NOT EXISTS users_hassle (chat_id TEXT UNIQUE)")
+        self.load_registered_users()
 
-            cursor.execute("SELECT * FROM tasks_hassle")
-            tasks = cursor.fetchall()
-            for task in tasks:
-                job = self.sched.add_job(self._hassle, "date", run_date=task[1], args=[task[0], task[3], 15])
-                self.jobs[task[0] + "␟" + task[3]] = (job, False)
+        self.scheduler.add_listener(self._job_missed, EVENT_JOB_MISSED)
+        self._schedule_window()
+        # Top up well before the end of the window so no task is loaded late
+        self.scheduler.add_job(self._schedule_window, "interval", seconds=self.window.total_seconds() / 2)
 
         logger.info("HassleBot initialised")
 
+    def _schedule_window(self) -> None:
+        """
+        Schedule every task due before the end of the window that isn't scheduled yet. Tasks that were due while the
+        bot wasn't running are scheduled straight away.
+        """
+        now = datetime.now()
+        horizon = now + self.window
+        with self.jobs_lock:
+            with self.db_cursor() as cursor:
+                cursor.execute(
+                    "SELECT name, alert_time, chat_id FROM tasks_hassle WHERE alert_time <= ? ORDER BY alert_time",
+                    (horizon.strftime(TIME_FORMAT),),
+                )
+                tasks = cursor.fetchall()
+            for name, alert_time, chat_id in tasks:
+                if name + "␟" + chat_id in self.jobs:
+                    continue
+                self._schedule_task(name, chat_id, max(datetime.strptime(alert_time, TIME_FORMAT), now))
+
+    def _schedule_task(self, name: str, chat_id: str, alert_time: datetime) -> None:
+        """
+        Schedule the first hassle of a task if it falls within the window, otherwise leave it to _schedule_window
+        """
+        if alert_time > datetime.now() + self.window:
+            return
+        with self.jobs_lock:
+            job = self.scheduler.add_job(self._hassle, "date", run_date=alert_time, args=[name, chat_id, 15])
+            self.jobs[name + "␟" + chat_id] = (job, False)
+
+    def _job_missed(self, event: JobExecutionEvent) -> None:
+        """
+        Forget a hassle job the scheduler skipped for running too late, so the next window top-up schedules its task
+        again instead of treating it as still scheduled
+        """
+        with self.jobs_lock:
+            for key, (job, hassling) in list(self.jobs.items()):
+                if job.id != event.job_id:
+                    continue
+                del self.jobs[key]
+                name, chat_id = key.split("␟")
+                if hassling and self.active.get(chat_id, {}).get(name) is job:
+                    del self.active[chat_id][name]
+                logger.warning(f'Hassle for "{name}" in chat {chat_id} was missed, rescheduling it')
+                return
+
     def _hassle(self, name: str, chat_id: str, next_delay: int) -> None:
         """
         Send notification message and schedule next message to be sent at decreasing interval
@@ -102,50 +160,48 @@ class HassleBot(DatabaseBot):
         )
         next_run = datetime.now() + timedelta(minutes=next_delay)
         next_delay = max(next_delay - 5, 5)
-        job = self.sched.add_job(self._hassle, "date", run_date=next_run, args=[name, chat_id, next_delay])
-        self.jobs[name + "␟" + chat_id] = (job, True)
+        with self.jobs_lock:
+            job = self.scheduler.add_job(self._hassle, "date", run_date=next_run, args=[name, chat_id, next_delay])
+            self.jobs[name + "␟" + chat_id] = (job, True)
+            self.active.setdefault(chat_id, {})[name] = job
 
     def handle_message(self, data):
         text: str = data["message"]["text"]
         chat_id = str(data["message"]["chat"]["id"])
 
-        with self.db_cursor() as cursor:
-            cursor.execute("SELECT chat_id FROM users_hassle")
-            users = cursor.fetchall()
-            if (chat_id,) not in users:
-                cursor.execute("INSERT INTO users_hassle (chat_id) VALUES (?)", (chat_id,))
-                self.send_message(
-                    "Welcome to HassleBot! Use the keyboard below to manage your task.\n\n"
-                    "HassleBot will hassle you (when you tell it to) about tasks you create until you clear them.",
-                    chat_id,
-                    CUSTOM_KEYBOARD,
-                )
-                return
+        if self.register_user(chat_id):
+            self.send_message(
+                "Welcome to HassleBot! Use the keyboard below to manage your task.\n\n"
+                "HassleBot will hassle you (when you tell it to) about tasks you create until you clear them.",
+                chat_id,
+                CUSTOM_KEYBOARD,
+            )
+            return
 
-        chat_state = self.state_manager[chat_id]
+        chat_state = self.conversations[chat_id]
         if text.lower() == "stop":
             self.send_message("Stopped", chat_id, CUSTOM_KEYBOARD)
-            del self.state_manager[chat_id]
+            self.conversations.clear(chat_id)
         elif chat_state is None:  # User has no ongoing operation
             if text == "Add":
                 self.send_message("Provide the name of the task.", chat_id, {"remove_keyboard": True})
-                self.state_manager[chat_id] = States.ADD_TASK
+                self.conversations[chat_id] = States.ADD_TASK
             elif text == "Remove":
                 if self._send_remove_options(chat_id):
-                    self.state_manager[chat_id] = States.REMOVE_TASK
+                    self.conversations[chat_id] = States.REMOVE_TASK
             elif text == "List":
                 self._send_list(chat_id)
             elif text == "Acknowledge":
                 self._handle_ack(chat_id)
         elif chat_state == States.ADD_TASK:
-            self.state_manager[chat_id] = States.SET_DATE
-            self.task_buffer[chat_id] = (text,)
+            self.conversations[chat_id] = States.SET_DATE
+            self.conversations.set_data(chat_id, (text,))
             self.send_message("Please provide a time for the alert in the format MM-DD HH:MM.", chat_id)
         elif chat_state == States.SET_DATE:
             if (date := _parse_date(text)) is None:
                 self.send_message("Invalid date or date in past. Please provide in MM-DD HH:MM format.", chat_id)
                 return
-            self.task_buffer[chat_id] = (self.task_buffer[chat_id][0], date)
+            self.conversations.set_data(chat_id, (self.conversations.get_data(chat_id)[0], date))
             self.send_message(
                 "How often should this task repeat?",
                 chat_id,
@@ -156,25 +212,24 @@ class HassleBot(DatabaseBot):
                     "is_persistent": True,
                 },
             )
-            self.state_manager[chat_id] = States.SET_REPEAT
+            self.conversations[chat_id] = States.SET_REPEAT
         elif chat_state == States.SET_REPEAT:
             if text not in ["Never", "Daily", "Weekly"]:
                 self.send_message("Selection invalid. Try again.", chat_id)
                 return
-            name, date = self.task_buffer[chat_id]
+            name, date = self.conversations.get_data(chat_id)
             with self.db_cursor() as cursor:
                 cursor.execute(
                     "INSERT INTO tasks_hassle (name, alert_time, repeat, chat_id) VALUES (?, ?, ?, ?)",
-                    (name, date, text, chat_id),
+                    (name, date.strftime(TIME_FORMAT), text, chat_id),
                 )
             self.send_message(
                 f'Created task "{name}". This task will alert at {date} and repeat {text.lower()}',
                 chat_id,
                 CUSTOM_KEYBOARD,
             )
-            job = self.sched.add_job(self._hassle, "date", run_date=date, args=[name, chat_id, 15])
-            self.jobs[name + "␟" + chat_id] = (job, False)
-            del self.state_manager[chat_id]
+            self._schedule_task(name, chat_id, date)
+            self.conversations.clear(chat_id)
         elif chat_state == States.REMOVE_TASK:
             with self.db_cursor() as cursor:
                 cursor.execute("SELECT * FROM tasks_hassle WHERE chat_id = ? AND name = ?", (chat_id, text))
@@ -183,43 +238,61 @@ class HassleBot(DatabaseBot):
                 else:
                     cursor.execute("DELETE FROM tasks_hassle WHERE chat_id = ? AND name = ?", (chat_id, text))
                     self.send_message(f'Task "{text}" deleted', chat_id, CUSTOM_KEYBOARD)
-            self.jobs.pop(text + "␟" + chat_id)[0].remove()
-            del self.state_manager[chat_id]
+            with self.jobs_lock:
+                scheduled = self.jobs.pop(text + "␟" + chat_id, None)
+                if scheduled is not None:
+                    _remove_job(scheduled[0])
+                self.active.get(chat_id, {}).pop(text, None)
+            del self.conversations[chat_id]
 
     def _handle_ack(self, chat_id: str):
         """
-        Handle the acknowledgement of the task
+        Handle the acknowledgement of every task currently hassling the chat
 
         :param chat_id:
         :return:
         """
-        for task_id, (job, active) in [(key, val) for (key, val) in self.jobs.items()]:
+        # Held until the new alert times are stored so the window top-up can't reschedule the old times
+        with self.jobs_lock:
+            active = self.active.pop(chat_id, {})
+            for task_name, job in active.items():
+                _remove_job(job)
+                self.jobs.pop(task_name + "␟" + chat_id, None)
             if not active:
-                continue
-            job.remove()
-            del self.jobs[task_id]
-            task_name = task_id.split("␟")[0]
+                return
+
+            placeholders = ", ".join("?" * len(active))
+            new_times = {}
+            now = datetime.now()
             with self.db_cursor() as cursor:
-                cursor.execute("SELECT * FROM tasks_hassle WHERE chat_id = ? AND name = ?", (chat_id, task_name))
-                task = cursor.fetchone()
-                if task[2] == "Never":
-                    cursor.execute("DELETE FROM tasks_hassle WHERE chat_id = ? AND name = ?", (chat_id, task_name))
-                    new_time = None
-                else:
-                    old_time = datetime.strptime(task[1], "%Y-%m-%d %H:%M:%S")
-                    if task[2] == "Weekly":
-                        new_time = old_time + timedelta(weeks=1)
-                    elif task[2] == "Daily":
-                        new_time = old_time + timedelta(days=1)
-                    cursor.execute(
-                        "UPDATE tasks_hassle SET alert_time=? WHERE chat_id=? AND name=?",
-                        (new_time, chat_id, task_name),
-                    )
-                    job = self.sched.add_job(self._hassle, "date", run_date=new_time, args=[task_name, chat_id, 15])
-                    self.jobs[task_id] = (job, False)
+                cursor.execute(
+                    f"SELECT name, alert_time, repeat FROM tasks_hassle WHERE chat_id = ? AND name IN ({placeholders})",
+                    (chat_id, *active),
+                )
+                for task_name, alert_time, repeat in cursor.fetchall():
+                    interval = {"Weekly": timedelta(weeks=1), "Daily": timedelta(days=1)}.get(repeat)
+                    if interval is None:
+                        continue
+                    new_time = datetime.strptime(alert_time, TIME_FORMAT) + interval
+                    # Skip the repeats that passed while the task was hassling, e.g. a daily task acknowledged late
+                    while new_time <= now:
+                        new_time += interval
+                    new_times[task_name] = new_time
+                cursor.execute(
+                    f"DELETE FROM tasks_hassle WHERE chat_id = ? AND repeat = 'Never' AND name IN ({placeholders})",
+                    (chat_id, *active),
+                )
+                cursor.executemany(
+                    "UPDATE tasks_hassle SET alert_time=? WHERE chat_id=? AND name=?",
+                    [(new_time.strftime(TIME_FORMAT), chat_id, name) for name, new_time in new_times.items()],
+                )
+            for task_name, new_time in new_times.items():
+                self._schedule_task(task_name, chat_id, new_time)
+
+        for task_name in active:
             message = f'"{task_name}" acknowledged.'
-            if new_time is not None:
-                message += f" Next alert scheduled for {new_time}."
+            if task_name in new_times:
+                message += f" Next alert scheduled for {new_times[task_name]}."
             self.send_message(message, chat_id, CUSTOM_KEYBOARD)
 
     def _send_remove_options(self, chat_id) -> bool:
@@ -241,13 +314,24 @@ class HassleBot(DatabaseBot):
 
     def _send_list(self, chat_id):
         with self.db_cursor() as cursor:
-            cursor.execute("SELECT name, alert_time, repeat FROM tasks_hassle WHERE chat_id = ?", (chat_id,))
+            cursor.execute(
+                "SELECT name, alert_time, repeat FROM tasks_hassle WHERE chat_id = ? ORDER BY alert_time", (chat_id,)
+            )
             rows = cursor.fetchall()
         if not rows:
             self.send_message("No tasks found.", chat_id, CUSTOM_KEYBOARD)
         else:
-            rows.sort(key=lambda x: datetime.strptime(x[1], "%Y-%m-%d %H:%M:%S"))
             message = "Tasks:\n"
             for row in rows:
                 message += f'- "{row[0]}" will alert at {row[1]} and repeat {row[2]}\n'
             self.send_message(message, chat_id, CUSTOM_KEYBOARD)
+
+
+def _remove_job(job: Job) -> None:
+    """
+    Remove a job from the scheduler, ignoring jobs that have already run
+    """
+    try:
+        job.remove()
+    except JobLookupError:
+        pass
@@ -0,0 +1,69 @@
+import hmac
+import logging
+from typing import Any, Callable, Dict, Mapping
+
+from telegram_bots import metrics
+from telegram_bots.bot import Bot
+from telegram_bots.logger import logger
+
+# Header Telegram sends the secret set with setWebhook in
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Seconds suggested to the sender when an update is rejected because the queues are full
+RETRY_AFTER = "5"
+
+
+def authenticate(bot: Bot | None, secret: str | None) -> bool:
+    """
+    Checks the secret sent with an update in constant time, before anything else about the request is looked at
+
+    :param bot: Bot the request is addressed to, or None if the host doesn't match a bot
+    :param secret: Value of the secret token header, if sent
+    :return: Whether the request may be handled by the bot
+    """
+    if bot is None or secret is None:
+        return False
+    return hmac.compare_digest(secret.encode(), bot.secret_token.encode())
+
+
+def accepts(bot: Bot, update: Any) -> bool:
+    """
+    :param bot: Bot the update is for
+    :param update: Parsed update payload
+    :return: Whether the update is of a type the bot handles, and so should be queued
+    """
+    return isinstance(update, dict) and any(update_type in update for update_type in bot.update_types)
+
+
+def submit_once(bot: Bot, update: Dict[str, Any], submit: Callable[[Bot, Dict[str, Any]], bool]) -> bool:
+    """
+    Queue an update unless the bot has already received it, redeliveries are acknowledged without being queued again
+
+    :param bot: Bot the update is for
+    :param update: Parsed update payload
+    :param submit: Queues the update, returning False if the queues are full
+    :return: False if the update is new but couldn't be queued
+    """
+    update_id = update.get("update_id")
+    if isinstance(update_id, int) and not bot.recent_updates.add(update_id):
+        logger.debug("Dropping redelivered update %s", update_id)
+        metrics.UPDATES_DROPPED.inc(bot=type(bot).__name__, reason="duplicate")
+        return True
+    if submit(bot, update):
+        return True
+    if isinstance(update_id, int):
+        # Accept the update when Telegram retries it
+        bot.recent_updates.discard(update_id)
+    return False
+
+
+def log_request(route: str, headers: Mapping[str, str], payload: Dict[str, Any] | None = None) -> None:
+    """
+    Log a request's headers and payload, only building the messages when debug logging is enabled
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    logger.debug("%s received", route)
+    # The secret is the only thing authenticating updates, so it is kept out of the logs
+    logger.debug("Headers: %s", {key: value for key, value in headers.items() if key.lower() != SECRET_HEADER.lower()})
+    if payload is not None:
+        logger.debug("JSON payload: %s", payload)
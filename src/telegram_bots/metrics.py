@@ -0,0 +1,168 @@
+"""
+Process wide metrics, rendered in the Prometheus text exposition format by the /metrics route.
+
+Metrics are declared once at module level and updated from wherever the measured work happens. Label values should
+come from a small fixed set, e.g. bot class names or Bot API method names, never from chat IDs or message text.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Generator, List, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds, covering everything from a cached SQLite read to a slow video job
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_registry: List["_Metric"] = []
+
+
+class _Metric:
+    kind: str
+    name: str
+    documentation: str
+    labelnames: Tuple[str, ...]
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        if labels.keys() != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key: Tuple[str, ...], value) -> List[str]:
+        return [f"{self.name}{self._labels(key)} {_format(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+    buckets: Tuple[float, ...]
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            # Per bucket counts, the last being +Inf, followed by the sum of every observation
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+                    break
+            else:
+                state[len(self.buckets)] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Generator[None]:
+        """
+        Observes how long the block takes, including when it raises
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self, key: Tuple[str, ...], state) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), state):
+            cumulative += count
+            le = 'le="' + _format(bound) + '"'
+            lines.append(f"{self.name}_bucket{self._labels(key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(key)} {_format(state[-1])}")
+        lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """
+    :return: Every registered metric in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+QUEUE_DEPTH = Gauge("telegram_bots_queue_depth", "Updates waiting on each worker shard", ["shard"])
+QUEUE_WAIT = Histogram("telegram_bots_queue_wait_seconds", "Time updates wait on a shard before handling", ["bot"])
+UPDATES_DROPPED = Counter(
+    "telegram_bots_updates_dropped_total",
+    "Updates rejected because a queue was full, or dropped because they waited too long or were redelivered",
+    ["bot", "reason"],
+)
+HANDLER_SECONDS = Histogram(
+    "telegram_bots_handler_seconds", "Time spent in handle_message by conversation state", ["bot", "state"]
+)
+HANDLER_ERRORS = Counter("telegram_bots_handler_errors_total", "Updates whose handler raised", ["bot"])
+API_SECONDS = Histogram("telegram_bots_api_seconds", "Bot API call latency including retries, by method", ["method"])
+API_ERRORS = Counter("telegram_bots_api_errors_total", "Bot API calls that failed after retries, by method", ["method"])
+JOB_SECONDS = Histogram("telegram_bots_job_seconds", "Run time of scheduled jobs", ["job"])
+JOB_FAILURES = Counter("telegram_bots_job_failures_total", "Scheduled job runs that raised", ["job"])
+DB_SECONDS = Histogram(
+    "telegram_bots_db_seconds", "Time spent executing SQLite statements by statement type", ["query"]
+)
+POWER_METER_FPS = Histogram(
+    "telegram_bots_power_meter_fps",
+    "Video frames processed per second when reading a power meter",
+    buckets=(25, 50, 100, 200, 400, 800, 1600, 3200, 6400),
+)
+POWER_METER_FRAMES = Counter("telegram_bots_power_meter_frames_total", "Video frames processed by the power meter")
@@ -0,0 +1,141 @@
+import threading
+import time
+from typing import Any, Dict, List
+
+from telegram_bots.api_client import BotApiError
+from telegram_bots.bot import Bot
+from telegram_bots.ingress import accepts, submit_once
+from telegram_bots.logger import logger
+from telegram_bots.worker_pool import ShardedWorkerPool
+
+# Most updates getUpdates returns at once
+MAX_LIMIT = 100
+# Seconds to wait before polling again after getUpdates fails
+ERROR_DELAY = 5
+# Seconds to wait before retrying an update the worker queues had no room for
+FULL_DELAY = 0.1
+
+
+class Batch:
+    """
+    Counts the updates of a batch still being handled, so the offset is only moved past them once they all finish
+    """
+
+    def __init__(self):
+        self._remaining = 0
+        self._condition = threading.Condition()
+
+    def add(self) -> None:
+        with self._condition:
+            self._remaining += 1
+
+    def done(self) -> None:
+        with self._condition:
+            self._remaining -= 1
+            if self._remaining == 0:
+                self._condition.notify_all()
+
+    def wait(self) -> None:
+        with self._condition:
+            self._condition.wait_for(lambda: self._remaining == 0)
+
+
+class UpdatePoller:
+    """
+    Receives a bot's updates by long polling getUpdates instead of through a webhook, so no public endpoint is needed.
+
+    Each batch of up to limit updates is queued on the worker pool together, and the offset confirming them to
+    Telegram is only advanced once every update in the batch has been handled. Updates of a batch interrupted by a
+    restart are delivered again. Those already handled are only recognised by the bot's update window if it is
+    persisted with UPDATE_DEDUPE_PERSIST, otherwise they are handled a second time.
+    """
+
+    bot: Bot
+    pool: ShardedWorkerPool
+    timeout: int
+    limit: int
+    offset: int | None
+
+    def __init__(self, bot: Bot, pool: ShardedWorkerPool, timeout: int = 50, limit: int = MAX_LIMIT):
+        self.bot = bot
+        self.pool = pool
+        self.timeout = timeout
+        self.limit = min(limit, MAX_LIMIT)
+        self.offset = None
+        self._stop = threading.Event()
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, name=f"poller-{type(self.bot).__name__}", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        """
+        Stop polling and confirm the batches handled so far, so they aren't delivered again on the next start. Called
+        at exit, where the polling thread is usually waiting on a long poll and would be killed before it could
+        confirm them itself. The confirming call ends that long poll, and updates it returns are left unconfirmed.
+        """
+        self._stop.set()
+        if self.offset is not None:
+            try:
+                self.bot.api.call("getUpdates", {"offset": self.offset, "limit": 1, "timeout": 0})
+            except BotApiError as e:
+                logger.error(f"Failed to confirm updates for {type(self.bot).__name__}: {e}")
+
+    def run(self) -> None:
+        # getUpdates is refused while a webhook is set
+        try:
+            self.bot.api.call("deleteWebhook", {"drop_pending_updates": False})
+        except BotApiError as e:
+            logger.error(f"Failed to delete webhook for {type(self.bot).__name__}: {e}")
+        logger.info(f"Polling updates for {type(self.bot).__name__}")
+        while not self._stop.is_set():
+            try:
+                updates = self.poll()
+            except BotApiError as e:
+                if self._stop.is_set():  # Ended by the confirming call in stop
+                    break
+                logger.error(f"getUpdates failed for {type(self.bot).__name__}: {e}")
+                self._stop.wait(ERROR_DELAY)
+                continue
+            if self._stop.is_set():
+                break
+            self.handle_batch(updates)
+
+    def poll(self) -> List[Dict[str, Any]]:
+        """
+        :return: The next batch of updates, empty if none arrived before the long poll timed out
+        """
+        params = {"limit": self.limit, "timeout": self.timeout, "allowed_updates": list(self.bot.update_types)}
+        if self.offset is not None:
+            params["offset"] = self.offset
+        # Leave the request enough time for Telegram to hold it open for the whole long poll
+        return self.bot.api.call("getUpdates", params, timeout=self.timeout + 10)
+
+    def handle_batch(self, updates: List[Dict[str, Any]]) -> None:
+        """
+        Queue every update of a batch, wait for them all to be handled and advance the offset past them
+        """
+        if not updates:
+            return
+        batch = Batch()
+
+        def submit(bot: Bot, update: Dict[str, Any]) -> bool:
+            batch.add()
+            if not self.pool.submit(bot, update, batch.done):
+                batch.done()
+                return False
+            return True
+
+        for update in updates:
+            if not accepts(self.bot, update):
+                continue
+            # Unlike a webhook there is no one to retry a rejected update, so wait for room in the queues
+            while not submit_once(self.bot, update, submit):
+                if self._stop.is_set():
+                    # Leave the offset so the rest of the batch is delivered again
+                    batch.wait()
+                    return
+                time.sleep(FULL_DELAY)
+        batch.wait()
+        self.offset = max(update["update_id"] for update in updates) + 1
@@ -0,0 +1,263 @@
+"""
+Opt-in sampling profiler for finding where slow handlers spend their time.
+
+Work is profiled inside sections, e.g. a bot handling an update or a scheduled job running. While enabled, a sampler
+thread periodically records the stack of every thread inside a section, and writes them per section label as
+collapsed stacks ("frame;frame;frame count" lines) that flamegraph.pl, speedscope and similar tools read. The slowest
+sections are also logged with the time they spent in SQLite and the Bot API.
+
+Enabled from the start with PROFILE_ENABLED=true, or toggled at runtime by sending the process SIGUSR1.
+"""
+
+import heapq
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Generator, List, Tuple
+
+from telegram_bots.logger import logger
+
+# Deepest stack recorded, deeper frames are cut off at the root end
+MAX_DEPTH = 128
+# Seconds between collapsed stack files being rewritten while enabled
+FLUSH_INTERVAL = 60
+
+
+@dataclass(order=True)
+class SectionTiming:
+    seconds: float
+    label: str = field(compare=False)
+    description: str = field(compare=False)
+    # Seconds spent in each phase, e.g. db or api, the rest is reported as other
+    phases: Dict[str, float] = field(compare=False)
+
+
+class Profiler:
+    enabled: bool
+    directory: str
+    interval: float
+    slowest_count: int
+    stacks: Dict[str, Counter]
+    slowest: List[SectionTiming]
+
+    def __init__(self, directory: str = "profiles", interval: float = 0.01, slowest_count: int = 10):
+        self.enabled = False
+        self.directory = directory
+        self.interval = interval
+        self.slowest_count = slowest_count
+        self.stacks = {}
+        self.slowest = []
+        # Section label and phase times of each thread currently inside a section, keyed by thread ident
+        self._active: Dict[int, Tuple[str, Dict[str, float]]] = {}
+        self._lock = threading.Lock()
+        self._sampler: threading.Thread | None = None
+
+    def configure(self) -> None:
+        """
+        Read the PROFILE_* env vars, start profiling if enabled and toggle profiling on SIGUSR1. Must be called from
+        the main thread.
+        """
+        self.directory = os.getenv("PROFILE_DIR", "profiles")
+        self.interval = int(os.getenv("PROFILE_INTERVAL_MS", "10")) / 1000
+        self.slowest_count = int(os.getenv("PROFILE_SLOWEST", "10"))
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle())
+        if os.getenv("PROFILE_ENABLED", "false").lower() == "true":
+            self.start()
+
+    def start(self) -> None:
+        if self.enabled:
+            return
+        if self._sampler is not None:
+            # Let a sampler that was just stopped finish writing before starting another
+            self._sampler.join()
+        with self._lock:
+            # Each session writes and logs only what it sampled itself
+            self.stacks = {}
+            self.slowest = []
+            self.enabled = True
+            self._sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+            self._sampler.start()
+        logger.info(f"Profiling enabled, writing collapsed stacks to {self.directory}")
+
+    def stop(self) -> None:
+        """
+        Stop sampling, the sampler thread writes the collapsed stacks and logs the slowest sections before exiting
+        """
+        self.enabled = False
+
+    def toggle(self) -> None:
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    @contextmanager
+    def section(self, label: str, description: str = "") -> Generator[None]:
+        """
+        Profile the block under label while profiling is enabled. Sections don't nest, an inner section is part of
+        the outer one.
+
+        :param label: Name the collapsed stacks are written under, e.g. the bot's class name
+        :param description: Identifies this run in the slowest sections log, e.g. the update ID
+        """
+        ident = threading.get_ident()
+        phases: Dict[str, float] = {}
+        with self._lock:
+            profiled = self.enabled and ident not in self._active
+            if profiled:
+                self._active[ident] = (label, phases)
+        if not profiled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._active[ident]
+            self._record(SectionTiming(time.perf_counter() - start, label, description, phases))
+
+    def wrap(self, label: str, func: Callable[..., Any], description: str = "") -> Callable[..., Any]:
+        """
+        :return: func run inside a section, for work handed to another thread such as an executor
+        """
+
+        def run(*args: Any, **kwargs: Any) -> Any:
+            with self.section(label, description):
+                return func(*args, **kwargs)
+
+        return run
+
+    def add_phase(self, phase: str, seconds: float) -> None:
+        """
+        Attribute time to a phase of the calling thread's section, if it is in one
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            active = self._active.get(threading.get_ident())
+            if active is not None:
+                active[1][phase] = active[1].get(phase, 0.0) + seconds
+
+    def run_in_process(self, run: Callable[..., Any], label: str, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        Run func through a process pool runner such as VideoJobQueue.run, sampling it inside the child process while
+        profiling is enabled. The child's stacks are merged under label.
+
+        :param run: Submits a picklable function and its arguments to the process pool and returns the result
+        :param label: Name the collapsed stacks are written under
+        :param func: Picklable function to run
+        :param args: Arguments for func
+        :return: Result of func
+        """
+        if not self.enabled:
+            return run(func, *args)
+        result, stacks = run(_sample_call, self.interval, label, func, *args)
+        with self._lock:
+            self.stacks.setdefault(label, Counter()).update(stacks)
+        return result
+
+    def flush(self) -> None:
+        """
+        Write the collapsed stacks of every label, replacing earlier files
+        """
+        with self._lock:
+            stacks = {label: dict(counts) for label, counts in self.stacks.items()}
+        if not stacks:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for label, counts in stacks.items():
+            path = os.path.join(self.directory, f"{label}.collapsed")
+            with open(path + ".tmp", "w") as file:
+                file.writelines(f"{stack} {count}\n" for stack, count in counts.items())
+            os.replace(path + ".tmp", path)
+
+    def log_slowest(self) -> None:
+        with self._lock:
+            slowest = sorted(self.slowest, reverse=True)
+        for timing in slowest:
+            phases = dict(timing.phases)
+            phases["other"] = max(0.0, timing.seconds - sum(phases.values()))
+            breakdown = ", ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in phases.items())
+            logger.info(f"Slow {timing.label} {timing.description}: {timing.seconds * 1000:.0f}ms ({breakdown})")
+
+    def _record(self, timing: SectionTiming) -> None:
+        with self._lock:
+            if len(self.slowest) < self.slowest_count:
+                heapq.heappush(self.slowest, timing)
+            elif self.slowest and timing > self.slowest[0]:
+                heapq.heapreplace(self.slowest, timing)
+
+    def _sample(self, report: bool = True) -> None:
+        """
+        Sample until stopped
+
+        :param report: Whether to periodically write the collapsed stacks and log the slowest sections when stopped,
+            False in a child process that returns its stacks instead
+        """
+        next_flush = time.monotonic() + FLUSH_INTERVAL
+        while self.enabled:
+            time.sleep(self.interval)
+            self._sample_once()
+            if report and time.monotonic() >= next_flush:
+                self._flush_safely()
+                next_flush = time.monotonic() + FLUSH_INTERVAL
+        if report:
+            self._flush_safely()
+            self.log_slowest()
+            logger.info("Profiling disabled")
+
+    def _sample_once(self) -> None:
+        with self._lock:
+            active = {ident: label for ident, (label, _) in self._active.items()}
+        if not active:
+            return
+        frames = sys._current_frames()
+        samples = [(label, _collapse(frames[ident])) for ident, label in active.items() if ident in frames]
+        with self._lock:
+            for label, stack in samples:
+                self.stacks.setdefault(label, Counter())[stack] += 1
+
+    def _flush_safely(self) -> None:
+        try:
+            self.flush()
+        except OSError as e:
+            logger.error(f"Failed to write profiles: {e}")
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        names.append(f"{frame.f_globals.get('__name__', '?')}.{code.co_qualname}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _sample_call(interval: float, label: str, func: Callable[..., Any], *args: Any) -> Tuple[Any, Dict[str, int]]:
+    """
+    Runs in a child process, sampling func with a profiler of its own
+
+    :return: Result of func and its collapsed stacks
+    """
+    child = Profiler(interval=interval)
+    child.enabled = True
+    sampler = threading.Thread(target=child._sample, args=(False,), name="profiler", daemon=True)
+    sampler.start()
+    try:
+        with child.section(label):
+            result = func(*args)
+    finally:
+        child.enabled = False
+        sampler.join()
+    return result, dict(child.stacks.get(label, {}))
+
+
+# Shared by every bot in the process
+profiler = Profiler()
@@ -0,0 +1,89 @@
+import functools
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict
+
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.job import Job
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from telegram_bots import metrics
+from telegram_bots.logger import logger
+from telegram_bots.profiler import profiler
+
+
+@dataclass
+class JobMetrics:
+    runs: int = 0
+    failures: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+
+class SchedulerService:
+    """
+    Scheduler shared by every bot in the process, so scheduled work runs on one executor with a known size.
+
+    Jobs are registered through add_job, which wraps them to record how long each run takes.
+    """
+
+    scheduler: BackgroundScheduler
+    metrics: Dict[str, JobMetrics]
+
+    def __init__(self, max_workers: int, misfire_grace_time: int | None, coalesce: bool):
+        self.scheduler = BackgroundScheduler(
+            daemon=True,
+            executors={"default": ThreadPoolExecutor(max_workers)},
+            job_defaults={"misfire_grace_time": misfire_grace_time, "coalesce": coalesce},
+        )
+        self.metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    def start(self) -> None:
+        self.scheduler.start()
+
+    def shutdown(self) -> None:
+        if self.scheduler.running:
+            self.scheduler.shutdown()
+
+    def add_job(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Job:
+        """
+        Same as BackgroundScheduler.add_job, with the run time of the job recorded under its qualified name
+        """
+        name = kwargs.setdefault("name", getattr(func, "__qualname__", repr(func)))
+        return self.scheduler.add_job(self._timed(name, func), *args, **kwargs)
+
+    def add_listener(self, callback: Callable[[Any], None], mask: int) -> None:
+        """
+        Same as BackgroundScheduler.add_listener, e.g. to learn about jobs missed by more than the misfire grace time
+        """
+        self.scheduler.add_listener(callback, mask)
+
+    def _timed(self, name: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(func)
+        def run(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            failed = False
+            try:
+                with profiler.section(name):
+                    return func(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                self._record(name, time.perf_counter() - start, failed)
+
+        return run
+
+    def _record(self, name: str, seconds: float, failed: bool) -> None:
+        with self._metrics_lock:
+            job_metrics = self.metrics.setdefault(name, JobMetrics())
+            job_metrics.runs += 1
+            job_metrics.failures += failed
+            job_metrics.total_seconds += seconds
+            job_metrics.max_seconds = max(job_metrics.max_seconds, seconds)
+        metrics.JOB_SECONDS.observe(seconds, job=name)
+        if failed:
+            metrics.JOB_FAILURES.inc(job=name)
+        logger.debug(f"Scheduled job {name} took {seconds:.3f}s")
@@ -0,0 +1,156 @@
+"""
+Benchmark for the power meter reader.
+
+Generates synthetic power meter videos with a known power draw, runs each engine over them and reports throughput,
+wall time, peak memory and error against the true power draw. Runs offline, e.g.
+
+    uv run bench-power-meter --engine exact --engine adaptive
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+import cv2
+import numpy as np
+
+from telegram_bots.tools.tool_util import measure_power
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    watts: float
+    width: int = 1280
+    height: int = 720
+    fps: int = 30
+    duration: float = 20.0
+    # How long the LED stays lit for each Wh
+    blink_seconds: float = 0.1
+    # Standard deviation of the gaussian noise added to every frame
+    noise: float = 0.0
+    lead_dark_seconds: float = 0.0
+    trail_dark_seconds: float = 0.0
+
+
+SCENARIOS: List[Scenario] = [
+    Scenario("720p30", 1000),
+    Scenario("720p30-low", 250, duration=45),
+    Scenario("1080p60", 2500, width=1920, height=1080, fps=60),
+    Scenario("1080p30-portrait", 1500, width=1080, height=1920),
+    Scenario("480p30-noisy", 1800, width=854, height=480, noise=12),
+    Scenario("720p30-dark-ends", 1200, lead_dark_seconds=3, trail_dark_seconds=4),
+    Scenario("720p60-short-blink", 3000, fps=60, blink_seconds=0.04),
+    Scenario("2160p30", 800, width=3840, height=2160, duration=10),
+]
+
+
+def _engine(stride: int) -> Callable[[str], float]:
+    def run(path: str) -> float:
+        return measure_power(path, stride)
+
+    return run
+
+
+ENGINES: Dict[str, Callable[[str], float]] = {
+    "exact": _engine(1),
+    "adaptive": _engine(4),
+}
+
+
+def generate_video(scenario: Scenario, path: str) -> None:
+    """
+    Writes a video of a dark meter face with a red LED blinking once per Wh
+
+    :param scenario: Scenario to render
+    :param path: Where to write the video
+    :return: None
+    """
+    rng = np.random.default_rng(0)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), scenario.fps, (scenario.width, scenario.height))
+    period = 3600 / scenario.watts
+    radius = max(4, min(scenario.width, scenario.height) // 40)
+    centre = (scenario.width // 2, scenario.height // 2)
+    background = np.full((scenario.height, scenario.width, 3), 20, dtype=np.uint8)
+    blink_end = scenario.duration - scenario.trail_dark_seconds
+
+    for index in range(int(scenario.duration * scenario.fps)):
+        t = index / scenario.fps
+        frame = background.copy()
+        since_start = t - scenario.lead_dark_seconds
+        if 0 <= since_start and t < blink_end and since_start % period < scenario.blink_seconds:
+            cv2.circle(frame, centre, radius, (40, 40, 255), -1)
+        if scenario.noise:
+            noise = rng.normal(0, scenario.noise, frame.shape)
+            frame = np.clip(frame + noise, 0, 255).astype(np.uint8)
+        writer.write(frame)
+    writer.release()
+
+
+def _run_engine(engine: str, path: str) -> tuple[float, float, int]:
+    start = time.perf_counter()
+    watts = ENGINES[engine](path)
+    wall = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux and is the peak for this process, which only ever runs one engine
+    return watts, wall, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(scenarios: List[Scenario], engines: List[str], directory: str) -> None:
+    print(
+        f"{'scenario':<20} {'engine':<10} {'frames':>7} {'fps':>8} {'wall s':>8} "
+        f"{'peak MiB':>9} {'watts':>8} {'error':>7}"
+    )
+    context = multiprocessing.get_context("spawn")
+    for scenario in scenarios:
+        path = os.path.join(directory, f"{scenario.name}.mp4")
+        if not os.path.exists(path):
+            generate_video(scenario, path)
+        frame_count = int(cv2.VideoCapture(path).get(cv2.CAP_PROP_FRAME_COUNT))
+
+        for engine in engines:
+            # Each engine runs in a fresh process so peak memory isn't carried over from earlier runs
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                try:
+                    watts, wall, peak = pool.submit(_run_engine, engine, path).result()
+                except Exception as e:
+                    print(f"{scenario.name:<20} {engine:<10} failed: {type(e).__name__}: {e}")
+                    continue
+            error = (watts - scenario.watts) / scenario.watts * 100
+            print(
+                f"{scenario.name:<20} {engine:<10} {frame_count:>7} {frame_count / wall:>8.1f} {wall:>8.2f} "
+                f"{peak / 1024:>9.1f} {watts:>8.1f} {error:>6.2f}%"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark power meter reading on synthetic videos")
+    parser.add_argument(
+        "--engine", action="append", choices=list(ENGINES), help="Engine to run, may be repeated (default all)"
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=[s.name for s in SCENARIOS],
+        help="Scenario to run, may be repeated (default all)",
+    )
+    parser.add_argument("--video-dir", help="Directory to generate videos in and reuse between runs")
+    args = parser.parse_args()
+
+    engines = args.engine or list(ENGINES)
+    scenarios = [s for s in SCENARIOS if args.scenario is None or s.name in args.scenario]
+    if args.video_dir is not None:
+        os.makedirs(args.video_dir, exist_ok=True)
+        run(scenarios, engines, args.video_dir)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            run(scenarios, engines, directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import os
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Generator
+
+from telegram_bots.api_client import BotApiClient
+from telegram_bots.logger import logger
+
+# Bytes read from the start of an MP4 to find whether its index comes before the media data
+HEAD_SIZE = 64 * 1024
+
+
+class FileFetcher:
+    """
+    Makes files sent to a bot readable by OpenCV, whether the Bot API is the cloud API or a local server.
+
+    A local server started with --local returns absolute paths on a filesystem we share, which are read in place. Any
+    other file is downloaded in chunks to a temporary file, with at most max_downloads running at once. If stream is
+    set, MP4s with their index at the start ("faststart") are decoded straight from the download URL instead, so
+    decoding starts before the whole file has arrived.
+    """
+
+    api: BotApiClient
+    stream: bool
+
+    def __init__(self, api: BotApiClient, max_downloads: int, stream: bool = False):
+        self.api = api
+        self.stream = stream
+        self._downloads = threading.BoundedSemaphore(max_downloads)
+
+    @contextmanager
+    def open(self, file_path: str) -> Generator[str]:
+        """
+        Yields a path or URL OpenCV can read the file from. Local and downloaded files are deleted on exit, also when
+        reading them fails.
+
+        :param file_path: file_path returned by getFile
+        """
+        if os.path.isabs(file_path) and os.path.exists(file_path):
+            try:
+                yield file_path
+            finally:
+                _remove(file_path)
+            return
+
+        if self.stream and file_path.lower().endswith(".mp4"):
+            if is_faststart(self.api.read_file_head(file_path, HEAD_SIZE)):
+                # OpenCV downloads the file while reading it, which counts towards max_downloads too
+                with self._downloads:
+                    yield self.api.file_url(file_path)
+                return
+
+        file = tempfile.NamedTemporaryFile(prefix="telegram-bots-", suffix=os.path.splitext(file_path)[1], delete=False)
+        try:
+            with file, self._downloads:
+                size = self.api.download(file_path, file)
+            logger.debug(f"Downloaded {file_path} ({size} bytes) to {file.name}")
+            yield file.name
+        finally:
+            _remove(file.name)
+
+
+def is_faststart(head: bytes) -> bool:
+    """
+    Walks the top level boxes of an MP4 to check whether the moov box, which indexes the media, comes before the
+    mdat box holding it. Only then can the video be decoded while it is still downloading.
+
+    :param head: Bytes from the start of the file
+    :return: Whether moov was found before mdat within head
+    """
+    offset = 0
+    while offset + 8 <= len(head):
+        size, box_type = struct.unpack(">I4s", head[offset : offset + 8])
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False
+        if size == 1:  # 64-bit size follows the type
+            if offset + 16 > len(head):
+                return False
+            size = struct.unpack(">Q", head[offset + 8 : offset + 16])[0]
+        if size < 8:  # 0 extends to the end of the file, anything else is malformed
+            return False
+        offset += size
+    return False
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Failed to remove {path}: {e}")
@@ -0,0 +1,115 @@
+import calendar
+from typing import List, Tuple
+
+import numpy as np
+
+# Width of the time slots occupancy counts are summarised over
+SLOT_MINUTES = 30
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+PERCENTILES = (25, 50, 75)
+
+# Adds a count to the running summary of its slot. The right-hand side of the update sees the values from before the
+# update, so this is Welford's algorithm with m2 += (x - mean)^2 * n / (n + 1).
+UPSERT_SUMMARY = """
+    INSERT INTO occupancy_summary_tools (weekday, slot, n, mean, m2, min, max) VALUES (?, ?, 1, ?, 0, ?, ?)
+    ON CONFLICT (weekday, slot) DO UPDATE SET
+        n = n + 1,
+        mean = mean + (excluded.mean - mean) / (n + 1),
+        m2 = m2 + (excluded.mean - mean) * (excluded.mean - mean) * n / (n + 1.0),
+        min = MIN(min, excluded.min),
+        max = MAX(max, excluded.max)
+"""
+
+
+def parse_weekday(text: str) -> int | None:
+    """
+    Resolves a day name or an unambiguous prefix of one, e.g. "Mon", to a weekday number with Monday as 0
+
+    :param text: Day name or prefix
+    :return: Weekday number or None if the text doesn't identify a single day
+    """
+    text = text.strip().lower()
+    matches = [i for i, day in enumerate(calendar.day_name) if text and day.lower().startswith(text)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def format_time(weekday: int, minute_of_day: int) -> str:
+    hour, minute = divmod(minute_of_day, 60)
+    if hour > 12:
+        hour -= 12
+        period = "pm"
+    else:
+        period = "am"
+    return f"{calendar.day_name[weekday]} {hour}:{minute:02d}{period}"
+
+
+def summary_values(weekday: int, minute_of_day: int, count: int) -> Tuple[int, int, float, int, int]:
+    """
+    :return: Parameters for UPSERT_SUMMARY for a single count
+    """
+    return weekday, minute_of_day // SLOT_MINUTES, float(count), count, count
+
+
+def build_summary(rows: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int, float, float, int, int]]:
+    """
+    Summarises raw counts per weekday and slot in one vectorised pass, used to backfill the summary table
+
+    :param rows: (weekday, minute, count) rows from occupancy_tools
+    :return: (weekday, slot, n, mean, m2, min, max) rows for occupancy_summary_tools
+    """
+    if not rows:
+        return []
+    data = np.asarray(rows, dtype=np.int64)
+    counts = data[:, 2].astype(np.float64)
+    keys = data[:, 0] * SLOTS_PER_DAY + data[:, 1] // SLOT_MINUTES
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+
+    n = np.bincount(inverse)
+    mean = np.bincount(inverse, weights=counts) / n
+    m2 = np.bincount(inverse, weights=(counts - mean[inverse]) ** 2)
+    minimum = np.full(len(unique_keys), np.inf)
+    maximum = np.full(len(unique_keys), -np.inf)
+    np.minimum.at(minimum, inverse, counts)
+    np.maximum.at(maximum, inverse, counts)
+
+    weekdays, slots = np.divmod(unique_keys, SLOTS_PER_DAY)
+    return [
+        (int(weekdays[i]), int(slots[i]), int(n[i]), float(mean[i]), float(m2[i]), int(minimum[i]), int(maximum[i]))
+        for i in range(len(unique_keys))
+    ]
+
+
+def slot_percentiles(rows: List[Tuple[int, int]]) -> dict[int, np.ndarray]:
+    """
+    :param rows: (minute, count) rows for a single weekday, ordered by minute
+    :return: Dict of slot to the PERCENTILES of its counts
+    """
+    if not rows:
+        return {}
+    data = np.asarray(rows, dtype=np.int64)
+    slots = data[:, 0] // SLOT_MINUTES
+    # Rows are ordered by minute, so each slot's counts are contiguous
+    boundaries = np.flatnonzero(np.diff(slots)) + 1
+    return {
+        int(group_slots[0]): np.percentile(group_counts, PERCENTILES)
+        for group_slots, group_counts in zip(np.split(slots, boundaries), np.split(data[:, 1], boundaries))
+    }
+
+
+def format_summary(weekday: int, summary: List[Tuple[int, int, float, float, int, int]], percentiles=None) -> str:
+    """
+    :param weekday: Weekday the summary is for
+    :param summary: (slot, n, mean, m2, min, max) rows ordered by slot
+    :param percentiles: Optional dict of slot to percentiles from slot_percentiles
+    :return: One line per slot
+    """
+    lines = []
+    for slot, n, mean, m2, minimum, maximum in summary:
+        deviation = (m2 / (n - 1)) ** 0.5 if n > 1 else 0.0
+        line = (
+            f"{format_time(weekday, slot * SLOT_MINUTES):18} {mean:5.1f} ±{deviation:4.1f} [{minimum}-{maximum}] n={n}"
+        )
+        if percentiles is not None and slot in percentiles:
+            line += " p" + "/".join(str(p) for p in PERCENTILES) + " " + "/".join(f"{v:g}" for v in percentiles[slot])
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,76 @@
+import threading
+import time
+from sqlite3 import Cursor
+from typing import Callable, ContextManager
+
+
+class PowerMeterCache:
+    """
+    Persistent cache of power meter readings keyed by Telegram's file_unique_id, which stays the same when a video is
+    forwarded or sent again. Entries expire after ttl seconds and the least recently used are evicted beyond max_size.
+    """
+
+    ttl: float
+    max_size: int
+    hits: int
+    misses: int
+
+    def __init__(self, db_cursor: Callable[[], ContextManager[Cursor]], ttl: float, max_size: int):
+        self.db_cursor = db_cursor
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        with self.db_cursor() as cursor:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS power_meter_cache_tools "
+                "(file_unique_id TEXT PRIMARY KEY, result TEXT, created REAL, last_used REAL)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS power_meter_cache_tools_last_used ON power_meter_cache_tools (last_used)"
+            )
+
+    def get(self, file_unique_id: str) -> str | None:
+        """
+        :param file_unique_id: Unique ID of the video
+        :return: Cached reading or None if the video hasn't been read recently
+        """
+        now = time.time()
+        with self.db_cursor() as cursor:
+            cursor.execute(
+                "SELECT result FROM power_meter_cache_tools WHERE file_unique_id = ? AND created > ?",
+                (file_unique_id, now - self.ttl),
+            )
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute(
+                    "UPDATE power_meter_cache_tools SET last_used = ? WHERE file_unique_id = ?", (now, file_unique_id)
+                )
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if row is None else row[0]
+
+    def put(self, file_unique_id: str, result: str) -> None:
+        """
+        Store a reading, evicting expired and least recently used entries
+
+        :param file_unique_id: Unique ID of the video
+        :param result: Formatted reading
+        :return: None
+        """
+        now = time.time()
+        with self.db_cursor() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO power_meter_cache_tools VALUES (?, ?, ?, ?)", (file_unique_id, result, now, now)
+            )
+            cursor.execute("DELETE FROM power_meter_cache_tools WHERE created <= ?", (now - self.ttl,))
+            cursor.execute(
+                "DELETE FROM power_meter_cache_tools WHERE file_unique_id IN "
+                "(SELECT file_unique_id FROM power_meter_cache_tools ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
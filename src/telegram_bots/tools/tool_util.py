@@ -1,24 +1,82 @@
+import time
+from dataclasses import dataclass
+from typing import List, Tuple
+
 import cv2
+import numpy as np
+
+# Longest stride used when sampling frames, keeps short blinks from being skipped entirely on a steady meter
+MAX_STRIDE = 8
+# Number of frames decoded before they are analysed together, limited to BATCH_BYTES for high resolution videos
+BATCH_SIZE = 32
+BATCH_BYTES = 64 * 1024 * 1024
+# Red counts are normalised to a 720x1280 frame so the threshold doesn't depend on the video resolution
+REFERENCE_PIXELS = 720 * 1280
+# We consider a blink captured if more than 200 red pixels are detected
+RED_PIXEL_THRESHOLD = 200
+
 
+@dataclass(frozen=True)
+class PowerReading:
+    power_draw: str
+    # Frames of the video covered by the reading, including those skipped when sampling
+    frames: int
+    seconds: float
 
-def get_power_draw(path: str) -> str:
+
+def get_power_draw(path: str, stride: int = 1) -> str:
     """
     Calculates the power draw from a video of a power meter
 
-    :param path:
-    :return:
+    :param path: Path to the video
+    :param stride: Initial number of frames between analysed frames. 1 analyses every frame, anything higher samples
+        the video and adapts the stride to the blink rate seen so far.
+    :return: Formatted power draw
+    """
+    return read_power_draw(path, stride).power_draw
+
+
+def read_power_draw(path: str, stride: int = 1) -> PowerReading:
+    """
+    Same as get_power_draw, along with how many frames were processed and how long it took
+
+    :param path: Path to the video
+    :param stride: See get_power_draw
+    :return: PowerReading of the video
+    """
+    start = time.perf_counter()
+    wh, frames = _measure(path, stride)
+    if wh > 1000:
+        power_draw = f"{round(wh / 1000, 2)} kW"
+    else:
+        power_draw = f"{round(wh)} W"
+    return PowerReading(power_draw, frames, time.perf_counter() - start)
+
+
+def measure_power(path: str, stride: int = 1) -> float:
+    """
+    Measures the power draw in watts from a video of a power meter blinking once per Wh
+
+    :param path: Path to the video
+    :param stride: See get_power_draw
+    :return: Power draw in watts
+    """
+    return _measure(path, stride)[0]
+
+
+def _measure(path: str, stride: int) -> Tuple[float, int]:
+    """
+    :return: Power draw in watts and the number of frames covered
     """
     vidcap = cv2.VideoCapture(path)
 
     fps = round(vidcap.get(cv2.CAP_PROP_FPS), 1)
-    count = 0
-    frames = []
-    success, image = vidcap.read()
-    while success:
-        red_frame = get_red_count(image) > 200  # We consider a blink captured if more than 200 red pixels are detected
-        frames.append((red_frame, round(count / fps, 2)))
-        success, image = vidcap.read()
-        count += 1
+    if stride > 1:
+        frames = _sample_frames(vidcap, stride)
+    else:
+        frames = _read_frames(vidcap)
+    frame_count = frames[-1][1] + 1 if frames else 0
+    frames = [(red, round(index / fps, 2)) for red, index in frames]
 
     while not frames[0][0]:  # Remove leading non-red frames
         frames.pop(0)
@@ -34,30 +92,120 @@ def get_power_draw(path: str) -> str:
     gap_count = sum([not x[0] for x in compressed_frames])
     elapsed_seconds = compressed_frames[-1][1] - compressed_frames[0][1]
 
-    wh = (3600 * gap_count) / elapsed_seconds
-    if wh > 1000:
-        return f"{round(wh / 1000, 2)} kW"
-    else:
-        return f"{round(wh)} W"
+    return (3600 * gap_count) / elapsed_seconds, frame_count
 
 
-def get_red_count(image) -> int:
+def _is_red(image) -> bool:
+    return bool(get_red_counts(image[np.newaxis])[0] > RED_PIXEL_THRESHOLD)
+
+
+def _read_frames(vidcap: cv2.VideoCapture) -> List[Tuple[bool, int]]:
     """
-    Returns the number of red pixels in the image after scaling to 720x1280.
+    Analyses every frame of the video, BATCH_SIZE frames at a time or fewer for large frames
 
-    :param image:
-    :return:
+    :return: List of (is red, frame index)
     """
-    # Extract red channel
-    red = image[:, :, 2]
+    frames = []
+    batch = []
+    batch_size = BATCH_SIZE
+    success, image = vidcap.read()
+    while success:
+        if not batch:
+            batch_size = max(1, min(BATCH_SIZE, BATCH_BYTES // image.nbytes))
+        batch.append(image)
+        success, image = vidcap.read()
+        if len(batch) == batch_size or (not success and batch):
+            reds = get_red_counts(np.stack(batch)) > RED_PIXEL_THRESHOLD
+            frames.extend((bool(red), index) for index, red in enumerate(reds, start=len(frames)))
+            batch = []
+    return frames
+
+
+def _sample_frames(vidcap: cv2.VideoCapture, stride: int) -> List[Tuple[bool, int]]:
+    """
+    Analyses every Nth frame of the video, skipping the frames in between with grab() so they are never decoded into
+    images. The stride is adapted to half of the shortest red or dark run seen so far, so every blink and every
+    gap is still sampled at least once.
+
+    Only the first and last blink affect the elapsed time, so those two edges are refined afterward by seeking back
+    and analysing every frame between the samples either side of them.
+
+    :return: List of (is red, frame index)
+    """
+    frames = []
+    index = 0
+    run_start = 0
+    shortest_run = None
+    success, image = vidcap.read()
+    while success:
+        red = _is_red(image)
+        if frames and frames[-1][0] != red:
+            run = index - run_start
+            shortest_run = run if shortest_run is None else min(shortest_run, run)
+            stride = max(1, min(MAX_STRIDE, shortest_run // 2))
+            run_start = index
+        frames.append((red, index))
+
+        for _ in range(stride - 1):
+            if not vidcap.grab():
+                return _refine_edges(vidcap, frames)
+            index += 1
+        index += 1
+        success, image = vidcap.read()
 
-    # Scale image to 720x1280 max
-    h, w = red.shape[:2]
-    new_w = max(1, int(w * 1 / (w / 720)))
-    new_h = max(1, int(h * 1 / (h / 1280)))
-    red = cv2.resize(red, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    return _refine_edges(vidcap, frames)
+
+
+def _refine_edges(vidcap: cv2.VideoCapture, frames: List[Tuple[bool, int]]) -> List[Tuple[bool, int]]:
+    """
+    Replaces the samples around the first and last rising edge with every frame between them
+    """
+    rising = [i for i in range(1, len(frames)) if frames[i][0] and not frames[i - 1][0]]
+    if not rising:
+        return frames
+
+    edges = sorted({rising[0], rising[-1]}, reverse=True)
+    for edge in edges:  # Refine from the back so earlier positions stay valid
+        start, end = frames[edge - 1][1], frames[edge][1]
+        if end - start <= 1:
+            continue
+        vidcap.set(cv2.CAP_PROP_POS_FRAMES, start + 1)
+        refined = []
+        for index in range(start + 1, end):
+            success, image = vidcap.read()
+            if not success:
+                break
+            refined.append((_is_red(image), index))
+        frames[edge:edge] = refined
+    return frames
+
+
+def get_red_counts(frames: np.ndarray) -> np.ndarray:
+    """
+    Returns the number of red pixels in each frame of a stack, scaled to what a 720x1280 frame would contain.
+
+    Frames larger than the reference are decimated by taking every Nth pixel rather than resized, and the threshold
+    is applied to the remaining pixels directly.
+
+    :param frames: BGR frames with shape (count, height, width, 3)
+    :return: Red pixel count of each frame
+    """
+    h, w = frames.shape[1:3]
+    step = max(1, int((h * w / REFERENCE_PIXELS) ** 0.5))
+
+    # Extract red channel
+    red = frames[:, ::step, ::step, 2]
 
     # Count pixels above threshold 240
-    _, red = cv2.threshold(red, 240, 255, cv2.THRESH_BINARY)
-    num_pass = int(cv2.countNonZero(red))
-    return num_pass
+    counts = np.count_nonzero(red > 240, axis=(1, 2))
+    return np.rint(counts * (REFERENCE_PIXELS / (red.shape[1] * red.shape[2]))).astype(np.int64)
+
+
+def get_red_count(image) -> int:
+    """
+    Returns the number of red pixels in the image, scaled to what a 720x1280 image would contain.
+
+    :param image:
+    :return:
+    """
+    return int(get_red_counts(image[np.newaxis])[0])
@@ -1,15 +1,18 @@
+import atexit
+import calendar
 import enum
-import json
 import os
 from datetime import datetime
-from typing import Tuple
 
-import requests
-
-from telegram_bots import util
+from telegram_bots import metrics, util
 from telegram_bots.bot import DatabaseBot
-from telegram_bots.tools.tool_util import get_power_draw
+from telegram_bots.tools import occupancy
+from telegram_bots.tools.file_fetch import FileFetcher
+from telegram_bots.tools.result_cache import PowerMeterCache
+from telegram_bots.tools.tool_util import read_power_draw
+from telegram_bots.tools.video_jobs import VideoJobQueue
 from telegram_bots.logger import logger
+from telegram_bots.profiler import profiler
 
 
 class States(enum.Enum):
@@ -30,15 +33,48 @@ CUSTOM_KEYBOARD = {
 
 
 class ToolsBot(DatabaseBot):
-    state_manager: util.StateManager = util.StateManager(States)
-    time_estimate: dict[str, Tuple[datetime, int]] = {}
+    # Conversation state, with the start time and estimate in minutes of a running time estimate as its data
+    conversations: util.ConversationStore
+    video_jobs: VideoJobQueue
+    power_meter_cache: PowerMeterCache
+    file_fetcher: FileFetcher
 
     def __init__(self, bot_token, bot_secret):
         logger.debug("Initialising ToolsBot...")
         super().__init__(f"bot{bot_token}", bot_secret)
+        self.conversations = util.ConversationStore(States)
+
+        self.video_jobs = VideoJobQueue(
+            int(os.getenv("POWER_METER_PROCESSES", "2")), int(os.getenv("POWER_METER_MAX_JOBS", "4"))
+        )
+        atexit.register(lambda: self.video_jobs.shutdown())
 
         with self.db_cursor() as cursor:
-            cursor.execute("CREATE TABLE IF NOT EXISTS occupancy_tools (time TEXT, count int)")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS occupancy_tools (recorded TEXT, weekday INTEGER, minute INTEGER, count int)"
+            )
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS occupancy_summary_tools (weekday INTEGER, slot INTEGER, n INTEGER, "
+                "mean REAL, m2 REAL, min INTEGER, max INTEGER, PRIMARY KEY (weekday, slot))"
+            )
+        self._migrate_occupancy()
+        with self.db_cursor() as cursor:
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS occupancy_tools_weekday_minute ON occupancy_tools (weekday, minute)"
+            )
+            summarised = cursor.execute("SELECT COUNT(*) FROM occupancy_summary_tools").fetchone()[0]
+        if summarised == 0:
+            self.rebuild_occupancy_summary()
+        self.power_meter_cache = PowerMeterCache(
+            self.db_cursor,
+            float(os.getenv("POWER_METER_CACHE_TTL", str(30 * 24 * 60 * 60))),
+            int(os.getenv("POWER_METER_CACHE_SIZE", "1000")),
+        )
+        self.file_fetcher = FileFetcher(
+            self.api,
+            int(os.getenv("POWER_METER_DOWNLOADS", "2")),
+            os.getenv("POWER_METER_STREAM", "false").lower() == "true",
+        )
         logger.info("ToolsBot initialised")
 
     def handle_message(self, data):
@@ -49,8 +85,8 @@ class ToolsBot(DatabaseBot):
         :return: None
         """
         message = data["message"]
-        chat_id = message["chat"]["id"]
-        state = self.state_manager.get_state(chat_id)
+        chat_id = str(message["chat"]["id"])
+        state = self.conversations.get_state(chat_id)
 
         if "text" in message:
             self.handle_text(chat_id, message, state)
@@ -82,7 +118,7 @@ class ToolsBot(DatabaseBot):
         if state is None:
             try:
                 new_state = States[text.upper().replace(" ", "_")]
-                self.state_manager.set_state(chat_id, new_state)
+                self.conversations.set_state(chat_id, new_state)
                 if new_state == States.POWER_METER:
                     self.send_message("Please send video", chat_id, replay_markup={"remove_keyboard": True})
                 elif new_state == States.CHECK_ESTIMATE:
@@ -117,10 +153,10 @@ class ToolsBot(DatabaseBot):
                 chat_id,
                 replay_markup=CUSTOM_KEYBOARD,
             )
-            self.state_manager.clear_state(chat_id)
+            self.conversations.clear_state(chat_id)
 
-        elif chat_id in self.time_estimate and text == "done":
-            start_time, estimate = self.time_estimate[chat_id]
+        elif text == "done" and (time_estimate := self.conversations.get_data(chat_id)) is not None:
+            start_time, estimate = time_estimate
             actual = round((datetime.now() - start_time).seconds / 60, 2)
             percent = round(100 / estimate * ((estimate - actual) if actual < estimate else (actual - estimate)), 1)
             self.send_message(
@@ -128,23 +164,27 @@ class ToolsBot(DatabaseBot):
                 chat_id,
                 replay_markup=CUSTOM_KEYBOARD,
             )
-            del self.time_estimate[chat_id]
+            self.conversations.clear_data(chat_id)
 
         elif text in ["stop", "cancel", "clear"]:
-            self.state_manager.clear_state(chat_id)
+            self.conversations.clear_state(chat_id)
             self.send_message(
                 "State cleared. Please select an option from the keyboard.", chat_id, replay_markup=CUSTOM_KEYBOARD
             )
 
         elif text == "debug":
-            debug_string = f"Current state: {self.state_manager.get_state(chat_id)}\n\n=====\nTime estimate\n"
+            debug_string = f"Current state: {self.conversations.get_state(chat_id)}\n\n=====\nTime estimate\n"
 
-            time_estimate = self.time_estimate.get(chat_id, None)
+            time_estimate = self.conversations.get_data(chat_id)
             if time_estimate is not None:
                 time_estimate = (
                     f"Start - {time_estimate[0].strftime("%Y-%m-%d %H:%M:%S")}, Estimate - {time_estimate[1]}"
                 )
-            debug_string += f"Stored estimate: {time_estimate}\n====="
+            debug_string += f"Stored estimate: {time_estimate}\n=====\n"
+            debug_string += (
+                f"Power meter cache: {self.power_meter_cache.hits} hits, {self.power_meter_cache.misses} misses\n"
+            )
+            debug_string += f"Conversations: {self.conversations.describe()}"
 
             self.send_message(debug_string, chat_id)
 
@@ -155,26 +195,47 @@ class ToolsBot(DatabaseBot):
 
     def read_power_meter(self, chat_id, message):
         """
-        Read power meter from video message and send result back to user
+        Queue a power meter video to be read, the result is sent back to the user once the job finishes
 
         :param chat_id: ID of the chat the message is from
         :param message: Message data
         :return:
         """
-        response = requests.get(
-            f"{os.getenv("BOT_API_URL")}/{self.api_token}/getFile?file_id={message["video"]['file_id']}"
-        )
-        response = response.json()
-        path = response["result"]["file_path"]
-        try:
-            power_draw = get_power_draw(path)
-            requests.post(
-                f"{os.getenv("BOT_API_URL")}/{self.api_token}/sendChatAction",
-                headers={"Content-Type": "application/json"},
-                data=json.dumps({"action": "typing", "chat_id": chat_id}),
-            )
+        file_unique_id = message["video"]["file_unique_id"]
+        if (power_draw := self.power_meter_cache.get(file_unique_id)) is not None:
             self.send_message(power_draw, chat_id, replay_markup=CUSTOM_KEYBOARD)
-            os.remove(path)
+            return
+
+        self.send_chat_action(chat_id)
+        path = self.api.call("getFile", {"file_id": message["video"]["file_id"]})["file_path"]
+        position = self.video_jobs.submit(self._send_power_draw, chat_id, path, file_unique_id)
+        if position > 0:
+            self.send_message(f"Busy, your video is queued at position {position}.", chat_id)
+
+    def _send_power_draw(self, chat_id, path: str, file_unique_id: str):
+        """
+        Read power meter in the process pool and send result back to user
+
+        :param chat_id: ID of the chat the video is from
+        :param path: file_path of the video returned by getFile
+        :param file_unique_id: Unique ID of the video the result is cached under
+        :return:
+        """
+        try:
+            self.send_chat_action(chat_id)
+            with self.file_fetcher.open(path) as source:
+                reading = profiler.run_in_process(
+                    self.video_jobs.run,
+                    f"{type(self).__name__}.read_power_draw",
+                    read_power_draw,
+                    source,
+                    int(os.getenv("POWER_METER_STRIDE", "1")),
+                )
+            metrics.POWER_METER_FRAMES.inc(reading.frames)
+            if reading.seconds > 0:
+                metrics.POWER_METER_FPS.observe(reading.frames / reading.seconds)
+            self.power_meter_cache.put(file_unique_id, reading.power_draw)
+            self.send_message(reading.power_draw, chat_id, replay_markup=CUSTOM_KEYBOARD)
         except Exception as e:
             self.send_message(f"Error: {e}", chat_id)
 
@@ -188,65 +249,92 @@ class ToolsBot(DatabaseBot):
         """
         try:
             estimate_minutes = int(text)
-            self.time_estimate[chat_id] = (datetime.now(), estimate_minutes)
+            self.conversations.set_data(chat_id, (datetime.now(), estimate_minutes))
             self.send_message(
                 'Estimate stored. Send "done" to complete estimate', chat_id, replay_markup=CUSTOM_KEYBOARD
             )
-            self.state_manager.clear_state(chat_id)
+            self.conversations.clear_state(chat_id)
         except ValueError:
             self.send_message("Please provide an estimate in minutes", chat_id)
 
+    def _migrate_occupancy(self):
+        """
+        Converts occupancy_tools from "%A %H:%M" strings in a time column to weekday and minute of day columns. The
+        full timestamp of migrated rows is unknown, so recorded is left empty for them.
+        """
+        with self.db_cursor() as cursor:
+            columns = [column[1] for column in cursor.execute("PRAGMA table_info(occupancy_tools)")]
+            if "time" not in columns:
+                return
+            logger.info("Migrating occupancy_tools to weekday and minute columns...")
+            cursor.execute("BEGIN")
+            for column in ("recorded TEXT", "weekday INTEGER", "minute INTEGER"):
+                if column.split(" ")[0] not in columns:
+                    cursor.execute(f"ALTER TABLE occupancy_tools ADD COLUMN {column}")
+            cursor.execute("SELECT rowid, time FROM occupancy_tools")
+            updates = []
+            for rowid, time in cursor.fetchall():
+                day, clock = time.split(" ")
+                hour, minute = clock.split(":")
+                updates.append((list(calendar.day_name).index(day), int(hour) * 60 + int(minute), rowid))
+            cursor.executemany("UPDATE occupancy_tools SET weekday = ?, minute = ? WHERE rowid = ?", updates)
+            cursor.execute("ALTER TABLE occupancy_tools DROP COLUMN time")
+
+    def rebuild_occupancy_summary(self):
+        """
+        Recompute occupancy_summary_tools from every raw count, e.g. after a backfill
+        """
+        with self.db_cursor() as cursor:
+            cursor.execute("SELECT weekday, minute, count FROM occupancy_tools")
+            summary = occupancy.build_summary(cursor.fetchall())
+            cursor.execute("DELETE FROM occupancy_summary_tools")
+            cursor.executemany("INSERT INTO occupancy_summary_tools VALUES (?, ?, ?, ?, ?, ?, ?)", summary)
+
     def store_or_retrieve_occupancy(self, chat_id: str, text: str):
         """
-        Store occupancy provided by user if given text is a number, or retrieve occupancy otherwise
+        Store occupancy provided by user if given text is a number, or retrieve a per time slot summary for a day
+        otherwise. Percentiles are included if the day is followed by "percentiles", e.g. "Mon percentiles".
 
         :param chat_id: ID of the chat the message is from
         :param text: Text content of the message
         :return:
         """
-
-        def sort_time(entry):
-            day_multi = {
-                "Monday": 0,
-                "Tuesday": 1,
-                "Wednesday": 2,
-                "Thursday": 3,
-                "Friday": 4,
-                "Saturday": 5,
-                "Sunday": 6,
-            }
-            time = entry[0]
-            day = time.split(" ")[0]
-            hour = time.split(" ")[1].split(":")[0]
-            minute = time.split(" ")[1].split(":")[1]
-            return day_multi[day] * 24 + int(hour) + float(f"0.{minute}")
-
         try:
             number = int(text)
-            with self.db_cursor() as cursor:
-                time = datetime.now().strftime("%A %H:%M")
-                cursor.execute("INSERT INTO occupancy_tools VALUES (?, ?)", (time, number))
-            self.send_message(f"Count of {number} stored for {time}", chat_id, replay_markup=CUSTOM_KEYBOARD)
-        except ValueError:  # Passed value is not a number
+            now = datetime.now()
+            minute = now.hour * 60 + now.minute
             with self.db_cursor() as cursor:
                 cursor.execute(
-                    "SELECT * FROM occupancy_tools WHERE time LIKE ?", (f"%{text}%",)
-                )  # Using fuzzy matching to allow for short names to be passed
-                counts = cursor.fetchall()
-            counts = sorted(counts, key=sort_time)
-            count_string = ""
-            for count in counts:
-                hour = int(count[0].split(":")[0].split(" ")[1])
-                if hour > 12:
-                    hour -= 12
-                    period = "pm"
-                else:
-                    period = "am"
-                time = f"{count[0].split(" ")[0]} {hour}:{count[0].split(":")[1]}{period}"
-                count_string += f"{time:18} {count[1]}\n"
-            if count_string == "":
+                    "INSERT INTO occupancy_tools (recorded, weekday, minute, count) VALUES (?, ?, ?, ?)",
+                    (now.isoformat(sep=" ", timespec="seconds"), now.weekday(), minute, number),
+                )
+                cursor.execute(occupancy.UPSERT_SUMMARY, occupancy.summary_values(now.weekday(), minute, number))
+            self.send_message(
+                f"Count of {number} stored for {now.strftime('%A %H:%M')}", chat_id, replay_markup=CUSTOM_KEYBOARD
+            )
+        except ValueError:  # Passed value is not a number
+            words = text.split()
+            weekday = occupancy.parse_weekday(words[0]) if words else None
+            summary = []
+            percentiles = None
+            if weekday is not None:
+                with self.db_cursor() as cursor:
+                    cursor.execute(
+                        "SELECT slot, n, mean, m2, min, max FROM occupancy_summary_tools WHERE weekday = ? "
+                        "ORDER BY slot",
+                        (weekday,),
+                    )
+                    summary = cursor.fetchall()
+                    if len(words) > 1 and words[1].lower() == "percentiles":
+                        cursor.execute(
+                            "SELECT minute, count FROM occupancy_tools WHERE weekday = ? ORDER BY minute", (weekday,)
+                        )
+                        percentiles = occupancy.slot_percentiles(cursor.fetchall())
+            if not summary:
                 self.send_message("No occupancy was found", chat_id)
             else:
-                self.send_message(count_string, chat_id, replay_markup=CUSTOM_KEYBOARD)
+                self.send_message(
+                    occupancy.format_summary(weekday, summary, percentiles), chat_id, replay_markup=CUSTOM_KEYBOARD
+                )
 
-        self.state_manager.clear_state(chat_id)
+        self.conversations.clear_state(chat_id)
@@ -0,0 +1,74 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+from telegram_bots.logger import logger
+
+
+class VideoJobQueue:
+    """
+    Runs CPU heavy video jobs away from the webhook workers.
+
+    Each job is coordinated by one of max_jobs runner threads, which hands the CPU heavy part to a shared process pool
+    and then delivers the result. Jobs submitted while every runner is busy wait in order for the next free runner.
+    A runner may also wait for a free process when max_jobs is larger than process_count.
+    """
+
+    max_jobs: int
+    process_count: int
+    processes: ProcessPoolExecutor
+    runners: ThreadPoolExecutor
+
+    def __init__(self, process_count: int, max_jobs: int):
+        self.max_jobs = max_jobs
+        self.process_count = process_count
+        # Spawn rather than fork so children don't inherit the locks and connections of the webhook threads
+        self.processes = ProcessPoolExecutor(max_workers=process_count, mp_context=multiprocessing.get_context("spawn"))
+        self.runners = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="video-job")
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiting = 0
+
+    def submit(self, job: Callable[..., None], *args: Any) -> int:
+        """
+        Queue a job to be run on a runner thread
+
+        :param job: Function coordinating the job, usually calling run() and sending the result
+        :param args: Arguments for the job
+        :return: 0 if a process is free for the job, otherwise its position in the queue, counting jobs ahead of it
+            that wait for a runner or for a process
+        """
+        with self._lock:
+            # Every unfinished job is either waiting or holds a runner, and at most process_count of them a process
+            position = max(0, self._running + self._waiting + 1 - self.process_count)
+            queued = self._running >= self.max_jobs or self._waiting > 0
+            if queued:
+                self._waiting += 1
+            else:
+                self._running += 1
+        self.runners.submit(self._run_job, job, queued, *args)
+        return position
+
+    def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        Run a function in the process pool and wait for its result. Should be called from within a job.
+        """
+        return self.processes.submit(func, *args).result()
+
+    def _run_job(self, job: Callable[..., None], queued: bool, *args: Any) -> None:
+        if queued:
+            with self._lock:
+                self._waiting -= 1
+                self._running += 1
+        try:
+            job(*args)
+        except Exception as e:
+            logger.error(f"Video job failed: {type(e).__name__}: {e}")
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def shutdown(self) -> None:
+        self.runners.shutdown(wait=False, cancel_futures=True)
+        self.processes.shutdown(wait=False, cancel_futures=True)
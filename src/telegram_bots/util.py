@@ -1,40 +1,173 @@
 import enum
+import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict
+from typing import Hashable, List, Type
 
+# Longest message text accepted by sendMessage
+MAX_MESSAGE_LENGTH = 4096
 
-class StateManager:
-    possible_states: enum.Enum
-    user_states: Dict[int, enum.Enum]
 
-    def __init__(self, states):
-        self.user_states = {}
+class _Conversation:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, touched: float):
+        self.state = -1
+        self.data = None
+        self.touched = touched
+
+
+class ConversationStore:
+    """
+    State and in-progress data of each chat's conversation with a bot. States are stored as their index in the enum
+    and conversations idle for longer than ttl seconds, or the least recently used beyond max_size, are dropped.
+
+    A conversation's data is kept when its state is cleared, so it can outlive the exchange that created it.
+    """
+
+    possible_states: Type[enum.Enum]
+    ttl: float
+    max_size: int
+    evicted: int
+
+    def __init__(self, states: Type[enum.Enum], ttl: float | None = None, max_size: int | None = None):
         self.possible_states = states
+        self._members = list(states)
+        self._codes = {state: code for code, state in enumerate(self._members)}
+        self.ttl = float(os.getenv("CONVERSATION_TTL", str(24 * 60 * 60))) if ttl is None else ttl
+        self.max_size = int(os.getenv("CONVERSATION_MAX", "10000")) if max_size is None else max_size
+        self.evicted = 0
+        self._conversations: OrderedDict[Hashable, _Conversation] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, chat_id, create: bool) -> _Conversation | None:
+        """
+        Look up a conversation and mark it as used, evicting idle conversations on the way. Must hold the lock.
+        """
+        now = time.monotonic()
+        # Oldest conversations are at the front, so eviction stops at the first one still in use
+        while self._conversations and now - next(iter(self._conversations.values())).touched > self.ttl:
+            self._conversations.popitem(last=False)
+            self.evicted += 1
+
+        conversation = self._conversations.get(chat_id)
+        if conversation is not None:
+            conversation.touched = now
+            self._conversations.move_to_end(chat_id)
+        elif create:
+            conversation = self._conversations[chat_id] = _Conversation(now)
+            while len(self._conversations) > self.max_size:
+                self._conversations.popitem(last=False)
+                self.evicted += 1
+        return conversation
+
+    def _release(self, chat_id, conversation: _Conversation) -> None:
+        if conversation.state < 0 and conversation.data is None:
+            self._conversations.pop(chat_id, None)
 
     def set_state(self, chat_id, state):
-        if state not in self.possible_states:
+        if state not in self._codes:
             raise ValueError(f"Invalid state: {state}\nPossible states: {self.possible_states}")
-        self.user_states[chat_id] = state
+        with self._lock:
+            self._get(chat_id, True).state = self._codes[state]
 
     def __setitem__(self, chat_id, state):
         self.set_state(chat_id, state)
 
     def get_state(self, chat_id):
-        return self.user_states.get(chat_id, None)
+        with self._lock:
+            conversation = self._get(chat_id, False)
+            if conversation is None or conversation.state < 0:
+                return None
+            return self._members[conversation.state]
 
     def __getitem__(self, chat_id):
         return self.get_state(chat_id)
 
+    def peek_state(self, chat_id):
+        """
+        Look up a chat's state without marking the conversation as used or evicting anything, e.g. for metrics
+        """
+        with self._lock:
+            conversation = self._conversations.get(chat_id)
+            if conversation is None or conversation.state < 0 or time.monotonic() - conversation.touched > self.ttl:
+                return None
+            return self._members[conversation.state]
+
     def clear_state(self, chat_id):
-        if chat_id in self.user_states:
-            del self.user_states[chat_id]
+        with self._lock:
+            if (conversation := self._conversations.get(chat_id)) is not None:
+                conversation.state = -1
+                self._release(chat_id, conversation)
 
     def __delitem__(self, chat_id):
         self.clear_state(chat_id)
 
+    def get_data(self, chat_id, default=None):
+        with self._lock:
+            conversation = self._get(chat_id, False)
+            return default if conversation is None or conversation.data is None else conversation.data
+
+    def set_data(self, chat_id, data):
+        with self._lock:
+            self._get(chat_id, True).data = data
+
+    def clear_data(self, chat_id):
+        with self._lock:
+            if (conversation := self._conversations.get(chat_id)) is not None:
+                conversation.data = None
+                self._release(chat_id, conversation)
+
+    def clear(self, chat_id):
+        """
+        Forget the conversation entirely, both state and data
+        """
+        with self._lock:
+            self._conversations.pop(chat_id, None)
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def describe(self) -> str:
+        """
+        :return: Human-readable summary of how many conversations are held and how many have been evicted
+        """
+        return f"{len(self)} conversations (max {self.max_size}, ttl {self.ttl:g}s), {self.evicted} evicted"
+
 
 def get_future_year(day: int, month: int) -> int:
     year = datetime.now().year
     if month < datetime.now().month or (month == datetime.now().month and day < datetime.now().day):
         year += 1
     return year
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Splits text into messages no longer than the limit, breaking between lines where possible
+
+    :param text: Text to split
+    :param limit: Maximum length of each message
+    :return: List of messages
+    """
+    messages = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:  # Lines that can't fit in a single message are broken up
+            if current:
+                messages.append(current)
+                current = ""
+            messages.append(line[:limit])
+            line = line[limit:]
+        if not current:
+            current = line
+        elif len(current) + 1 + len(line) <= limit:
+            current += "\n" + line
+        else:
+            messages.append(current)
+            current = line
+    if current:
+        messages.append(current)
+    return messages
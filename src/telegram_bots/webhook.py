@@ -1,7 +1,5 @@
+import atexit
 import os.path
-import queue
-import threading
-import traceback
 from typing import Dict
 
 from dotenv import load_dotenv
@@ -11,89 +9,92 @@ from waitress import serve
 from telegram_bots.hassle.hassle_bot import HassleBot
 from telegram_bots.logger import configure_logging
 from telegram_bots.logger import logger
+from telegram_bots.profiler import profiler
 
 load_dotenv()
 
+from telegram_bots import metrics
 from telegram_bots.bot import Bot
 from telegram_bots.expiry.expiry_bot import ExpiryBot
+from telegram_bots.ingress import RETRY_AFTER, SECRET_HEADER, accepts, authenticate, log_request, submit_once
+from telegram_bots.scheduler import SchedulerService
 from telegram_bots.tools.tools_bot import ToolsBot
+from telegram_bots.worker_pool import ShardedWorkerPool
 
 app = Flask(__name__)
 # Dict of subdomain to Bot instance
 bots: Dict[str, Bot] = {}
-task_q = queue.Queue()
-
-
-def worker():
-    while True:
-        bot, data = task_q.get()
-        try:
-            bot.handle_message(data)
-        except Exception as e:
-            error = f"{type(e).__name__}: {e}"
-            logger.error(error)
-            logger.error(traceback.format_exc())
-            try:
-                chat_id = data["message"]["chat"]["id"]
-                if chat_id is not None:
-                    bot.send_message(error, chat_id)
-            except Exception as e:
-                logger.error(f"Failed to send error message: {type(e).__name__}: {e}")
-                logger.error(traceback.format_exc())
-        finally:
-            task_q.task_done()
-
-
-threading.Thread(target=worker, daemon=True).start()
+# Only created when serving through waitress or polling, the asyncio server mode has its own pool
+pool: ShardedWorkerPool | None = None
+# Runs the scheduled jobs of every bot
+scheduler: SchedulerService | None = None
 
 
 @app.route("/health_check", methods=["GET"])
 def health_check():
-    logger.debug("Health check received")
-    logger.debug(f"Headers: {dict(request.headers)}")
-    logger.debug(f"JSON payload: {request.json}")
+    log_request("Health check", request.headers)
     # Webhooks are already specific to each bot
-    host = request.headers["host"].split(".")[0]
+    host = request.headers.get("host", "").split(".")[0]
     if host in bots:
-        return jsonify({"status": "ok"}), 200
+        return jsonify({"status": "ok", "queue_depths": pool.queue_depths()}), 200
     else:
         return jsonify({"status": "not found"}), 404
 
 
-@app.route("/webhook", methods=["POST"])
-def webhook():
-    logger.debug("Webhook received")
-    logger.debug(f"Headers: {dict(request.headers)}")
-    logger.debug(f"JSON payload: {request.json}")
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    for shard, depth in enumerate(pool.queue_depths()):
+        metrics.QUEUE_DEPTH.set(depth, shard=shard)
+    return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
 
-    host = request.headers["host"].split(".")[0]
-    bot = bots[host]
 
-    if (
-        "X-Telegram-Bot-Api-Secret-Token" not in request.headers
-        or request.headers["X-Telegram-Bot-Api-Secret-Token"] != bot.secret_token
-    ):
+@app.route("/webhook", methods=["POST"])
+def webhook():
+    host = request.headers.get("host", "").split(".")[0]
+    bot = bots.get(host)
+    if not authenticate(bot, request.headers.get(SECRET_HEADER)):
+        log_request("Webhook", request.headers)
         logger.debug("Authentication failed")
         return jsonify({"status": "unauthorized"}), 401
 
-    logger.info(
-        f"Webhook received for: {host}",
-    )
-    if "message" in request.json:
-        task_q.put((bot, request.json))
+    update = request.get_json(silent=True)
+    log_request("Webhook", request.headers, update)
+    if not isinstance(update, dict):
+        return jsonify({"status": "bad request"}), 400
+
+    logger.info("Webhook received for: %s", host)
+    if accepts(bot, update):
+        if not submit_once(bot, update, pool.submit):
+            # Telegram redelivers updates that weren't acknowledged with a 2xx
+            return jsonify({"status": "busy"}), 503, {"Retry-After": RETRY_AFTER}
         return jsonify({"status": "success"}), 200
     else:
-        return jsonify({"status": "success"}), 204
+        return "", 204
 
 
 def start():
+    global pool, scheduler
+
     configure_logging(os.getenv("LOGGING_LEVEL", "INFO"))
+    profiler.configure()
+    atexit.register(profiler.flush)
+
+    misfire_grace_time = os.getenv("SCHEDULER_MISFIRE_GRACE_TIME", "60")
+    scheduler = SchedulerService(
+        int(os.getenv("SCHEDULER_WORKERS", "4")),
+        int(misfire_grace_time) if misfire_grace_time else None,
+        os.getenv("SCHEDULER_COALESCE", "true").lower() == "true",
+    )
+    scheduler.start()
+    atexit.register(scheduler.shutdown)
+
     logger.debug("Initialising bots...")
 
     expiry_bot_token = os.getenv("EXPIRY_BOT_TOKEN")
     expiry_bot_secret = os.getenv("EXPIRY_BOT_SECRET")
     if expiry_bot_token and expiry_bot_secret:
-        bots["expiry-webhook"] = ExpiryBot(expiry_bot_token, expiry_bot_secret)
+        bots["expiry-webhook"] = ExpiryBot(expiry_bot_token, expiry_bot_secret, scheduler)
+        bots["expiry-webhook"].max_queued = _max_queued("EXPIRY")
     else:
         logger.info("Expiry bot token or secret not provided, not launching bot.")
 
@@ -101,18 +102,58 @@ def start():
     tools_bot_secret = os.getenv("TOOLS_BOT_SECRET")
     if tools_bot_token and tools_bot_secret:
         bots["tools-webhook"] = ToolsBot(tools_bot_token, tools_bot_secret)
+        bots["tools-webhook"].max_queued = _max_queued("TOOLS")
     else:
         logger.info("Tools bot token or secret not provided, not launching bot.")
 
     # hassle_bot_token = os.getenv("HASSLE_BOT_TOKEN")
     # hassle_bot_secret = os.getenv("HASSLE_BOT_SECRET")
     # if hassle_bot_token and hassle_bot_secret:
-    #     bots["hassle-webhook"] = HassleBot(hassle_bot_token, hassle_bot_secret)
+    #     bots["hassle-webhook"] = HassleBot(hassle_bot_token, hassle_bot_secret, scheduler)
+    #     bots["hassle-webhook"].max_queued = _max_queued("HASSLE")
     # else:
     #     logger.info("Hassle bot token or secret not provided, not launching bot.")
 
-    logger.info("Starting webhook server...")
-    serve(app, host="0.0.0.0", port=5000)
+    worker_count = int(os.getenv("WORKER_COUNT", "4"))
+    queue_size = int(os.getenv("WORKER_QUEUE_SIZE", "100"))
+    max_age = os.getenv("UPDATE_MAX_AGE", "300")
+    max_age = float(max_age) if max_age else None
+    server_mode = os.getenv("SERVER_MODE", "waitress")
+    if server_mode == "asyncio":
+        from telegram_bots import async_server
+
+        logger.info("Starting asyncio webhook server...")
+        async_server.serve(
+            bots, host="0.0.0.0", port=5000, pool_size=worker_count, queue_size=queue_size, max_age=max_age
+        )
+    elif server_mode == "waitress":
+        pool = ShardedWorkerPool(worker_count, queue_size, max_age)
+        logger.info("Starting webhook server...")
+        serve(app, host="0.0.0.0", port=5000)
+    elif server_mode == "polling":
+        from telegram_bots.polling import UpdatePoller
+
+        # Updates are confirmed to Telegram once their batch is handled, so a stale update that was dropped would be
+        # lost for good rather than delivered again
+        pool = ShardedWorkerPool(worker_count, queue_size)
+        for bot in bots.values():
+            poller = UpdatePoller(bot, pool, int(os.getenv("POLL_TIMEOUT", "50")), int(os.getenv("POLL_LIMIT", "100")))
+            atexit.register(poller.stop)
+            poller.start()
+        # Still served for /health_check and /metrics
+        logger.info("Starting server for polling mode...")
+        serve(app, host="0.0.0.0", port=5000)
+    else:
+        raise ValueError(f"Unknown SERVER_MODE: {server_mode}")
+
+
+def _max_queued(bot_name: str) -> int | None:
+    """
+    :param bot_name: Prefix of the bot's env vars, e.g. EXPIRY
+    :return: Most updates the bot may have queued at once, from <bot_name>_BOT_MAX_QUEUED
+    """
+    max_queued = os.getenv(f"{bot_name}_BOT_MAX_QUEUED")
+    return int(max_queued) if max_queued else None
 
 
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+import queue
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List
+
+from telegram_bots import metrics
+from telegram_bots.bot import Bot
+from telegram_bots.logger import logger
+from telegram_bots.profiler import profiler
+
+
+def get_chat_id(data: Dict[str, Any]) -> int | None:
+    """
+    Extracts the chat ID from an update, if it has one
+
+    :param data: Update payload from Telegram
+    :return: Chat ID or None if the update is not tied to a chat
+    """
+    message = data.get("message")
+    if message is None:
+        return None
+    return message.get("chat", {}).get("id")
+
+
+class PendingUpdates:
+    """
+    Counts the updates each bot has queued or in progress, so a bot's max_queued limit can be enforced across shards
+    """
+
+    def __init__(self):
+        self._counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, bot: Bot) -> bool:
+        """
+        :return: Whether the bot is below its limit, in which case the update is counted until release is called
+        """
+        with self._lock:
+            count = self._counts.get(id(bot), 0)
+            if bot.max_queued is not None and count >= bot.max_queued:
+                return False
+            self._counts[id(bot)] = count + 1
+            return True
+
+    def release(self, bot: Bot) -> None:
+        with self._lock:
+            self._counts[id(bot)] -= 1
+
+
+def is_expired(bot: Bot, data: Dict[str, Any], enqueued: float, max_age: float | None) -> bool:
+    """
+    Checks whether an update waited longer than max_age to be handled, recording it as dropped if so
+    """
+    if max_age is None or time.perf_counter() - enqueued <= max_age:
+        return False
+    logger.warning(f"Dropping update {data.get('update_id')} for {type(bot).__name__}, queued for over {max_age}s")
+    metrics.UPDATES_DROPPED.inc(bot=type(bot).__name__, reason="expired")
+    return True
+
+
+class ShardedWorkerPool:
+    """
+    Pool of worker threads where each (bot, chat) pair is pinned to a single shard.
+
+    Updates from the same chat are always handled by the same thread in the order they were submitted, while
+    different chats are spread over the remaining shards and handled in parallel.
+
+    Each shard holds at most queue_size updates and each bot at most its max_queued across every shard, beyond which
+    updates are rejected so Telegram redelivers them later. Updates that waited longer than max_age seconds are
+    dropped instead of handled.
+    """
+
+    shards: List[queue.Queue]
+    max_age: float | None
+    pending: PendingUpdates
+
+    def __init__(self, size: int, queue_size: int = 0, max_age: float | None = None):
+        if size < 1:
+            raise ValueError(f"Worker pool size must be at least 1, got {size}")
+        self.shards = [queue.Queue(queue_size) for _ in range(size)]
+        self.max_age = max_age
+        self.pending = PendingUpdates()
+        for index, shard in enumerate(self.shards):
+            threading.Thread(target=self._work, args=(shard,), name=f"worker-{index}", daemon=True).start()
+
+    def shard_for(self, bot: Bot, chat_id: int | None) -> int:
+        return hash((id(bot), chat_id)) % len(self.shards)
+
+    def submit(self, bot: Bot, data: Dict[str, Any], done: Callable[[], None] | None = None) -> bool:
+        """
+        Queue an update on the shard owning its chat
+
+        :param bot: Bot the update is for
+        :param data: Update payload from Telegram
+        :param done: Called once the update has been handled or dropped, if it was queued
+        :return: False if the shard or the bot's limit is full and the update wasn't queued
+        """
+        if not self.pending.acquire(bot):
+            metrics.UPDATES_DROPPED.inc(bot=type(bot).__name__, reason="bot_limit")
+            return False
+        try:
+            self.shards[self.shard_for(bot, get_chat_id(data))].put_nowait((bot, data, time.perf_counter(), done))
+        except queue.Full:
+            self.pending.release(bot)
+            metrics.UPDATES_DROPPED.inc(bot=type(bot).__name__, reason="queue_full")
+            return False
+        return True
+
+    def queue_depths(self) -> List[int]:
+        """
+        :return: Number of updates waiting on each shard
+        """
+        return [shard.qsize() for shard in self.shards]
+
+    def join(self) -> None:
+        """
+        Block until every queued update has been handled
+        """
+        for shard in self.shards:
+            shard.join()
+
+    def _work(self, shard: queue.Queue) -> None:
+        while True:
+            bot, data, enqueued, done = shard.get()
+            if is_expired(bot, data, enqueued, self.max_age):
+                self._finish(shard, bot, done)
+                continue
+            bot_name = type(bot).__name__
+            start = time.perf_counter()
+            metrics.QUEUE_WAIT.observe(start - enqueued, bot=bot_name)
+            state = "none"
+            try:
+                state = bot.state_label(data)
+                with profiler.section(bot_name, f"update {data.get('update_id')}"):
+                    bot.handle_message(data)
+            except Exception as e:
+                metrics.HANDLER_ERRORS.inc(bot=bot_name)
+                error = f"{type(e).__name__}: {e}"
+                logger.error(error)
+                logger.error(traceback.format_exc())
+                try:
+                    chat_id = get_chat_id(data)
+                    if chat_id is not None:
+                        bot.send_message(error, chat_id)
+                except Exception as e:
+                    logger.error(f"Failed to send error message: {type(e).__name__}: {e}")
+                    logger.error(traceback.format_exc())
+            finally:
+                metrics.HANDLER_SECONDS.observe(time.perf_counter() - start, bot=bot_name, state=state)
+                self._finish(shard, bot, done)
+
+    def _finish(self, shard: queue.Queue, bot: Bot, done: Callable[[], None] | None) -> None:
+        self.pending.release(bot)
+        if done is not None:
+            done()
+        shard.task_done()